@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import argparse
+import threading
+import itertools
+import concurrent.futures
+
+from tqdm import tqdm
+
+from capagent.indexing import batch_retrieve_cot_examples
+from capagent.utils import iter_jsonlines, append_jsonline
+from run import run_agent, get_executor_pool
+
+
+def load_completed_ids(output_path: str) -> set:
+    """
+    Ids that already have a successful result in the output file.
+    A run killed in the middle of `append_jsonline` leaves a torn last line without its newline. It is
+    truncated, so that the record is captioned again and the results appended next start on a line of their own.
+    """
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+
+    complete_size = 0
+    with open(output_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            complete_size += len(line)
+            if line.strip():
+                record = json.loads(line)
+                if record.get("error") is None:
+                    completed.add(record["id"])
+
+    if complete_size < os.path.getsize(output_path):
+        print(f"⚠️ Dropping the incomplete last line of {output_path}, left by an interrupted run.")
+        os.truncate(output_path, complete_size)
+    return completed
+
+
+def get_image_paths(record: dict):
+    if "image_paths" in record:
+        return record["image_paths"]
+    if "image" in record:
+        return [record["image"]]
+    return None
+
+
+def iter_chunks(iterable, size: int):
+    iterator = iter(iterable)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def caption_record(record: dict, working_dir: str, executor_pool, cot_examples: str = None) -> dict:
+    start = time.time()
+    result = {"id": record["id"], "query": record["query"], "result": None, "messages": [], "error": None}
+    try:
+        result["result"], result["messages"] = run_agent(
+            user_query=record["query"],
+            working_dir=working_dir,
+            image_paths=get_image_paths(record),
+            executor_pool=executor_pool,
+            cot_examples=cot_examples
+        )
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed"] = time.time() - start
+    return result
+
+
+def run_batch(input_path: str, output_path: str, concurrency: int = 4, working_dir: str = ".", retrieval_batch_size: int = 64):
+    """
+    Caption every record of `input_path` and append the results to `output_path`.
+
+    Input records are JSON objects with an "id", a "query" and either "image_paths" (a list) or
+    "image". Records are streamed from the input, at most `concurrency` agent sessions run at the
+    same time, and each result is written as soon as it is ready. Rerunning the same command
+    resumes after a crash: ids with a successful result in the output are skipped, failed ones are retried.
+    The CoT examples of every `retrieval_batch_size` records are retrieved together, with one embedding batch.
+    """
+    completed = load_completed_ids(output_path)
+    print(f"Resuming: {len(completed)} records already captioned.")
+
+    executor_pool = get_executor_pool(size=concurrency)
+    write_lock = threading.Lock()
+    n_failed = 0
+
+    # the thread pool is exited first, so every result is written before the file closes
+    with open(output_path, "a") as output_file, \
+            tqdm(desc="Captioning") as pbar, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+
+        def _write(future):
+            nonlocal n_failed
+            result = future.result()
+            with write_lock:
+                append_jsonline(result, output_file)
+                n_failed += result["error"] is not None
+                pbar.update(1)
+
+        # keep a bounded number of records in flight instead of reading the whole input up front
+        in_flight = set()
+        pending = (record for record in iter_jsonlines(input_path) if record["id"] not in completed)
+        for chunk in iter_chunks(pending, retrieval_batch_size):
+            try:
+                cot_examples = batch_retrieve_cot_examples([record["query"] for record in chunk])
+            except Exception as e:
+                # let every record retrieve its own examples, so a failure is recorded per record
+                print(f"⚠️ Batch retrieval failed, retrieving per record: {type(e).__name__}: {e}")
+                cot_examples = [None] * len(chunk)
+            for record, examples in zip(chunk, cot_examples):
+                if len(in_flight) >= 2 * concurrency:
+                    _, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                future = pool.submit(caption_record, record, working_dir, executor_pool, examples)
+                future.add_done_callback(_write)
+                in_flight.add(future)
+
+        concurrent.futures.wait(in_flight)
+
+    print(f"Done. {n_failed} records failed, rerun the same command to retry them.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("CapAgent batch captioning", add_help=True)
+    parser.add_argument("--input", type=str, required=True, help="JSONL file with id, query and image_paths/image per line")
+    parser.add_argument("--output", type=str, required=True, help="JSONL file the results are appended to")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of agent sessions running at the same time")
+    parser.add_argument("--working_dir", type=str, default=".", help="directory for the sessions' scratch files")
+    parser.add_argument("--retrieval_batch_size", type=int, default=64, help="number of queries whose CoT examples are retrieved together")
+    args = parser.parse_args()
+
+    run_batch(args.input, args.output, concurrency=args.concurrency, working_dir=args.working_dir, retrieval_batch_size=args.retrieval_batch_size)
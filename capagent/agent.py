@@ -1,9 +1,16 @@
+import re
+import queue
+import threading
+
 from autogen.agentchat import ConversableAgent, Agent
+from autogen.io import IOStream, IOConsole
 from autogen.runtime_logging import log_new_agent, logging_enabled
 
-from typing import Callable, Dict, List, Literal, Optional, Union
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Union
 
-from capagent.indexing import load_vector_store, query_vector_store
+from capagent.config import COT_EXAMPLES_RETRIEVAL, COT_EXAMPLES_ROUTING
+from capagent.example_routing import route_cot_examples
+from capagent.indexing import load_vector_store, query_vector_store, load_example_index, query_example_index, load_hybrid_index
 
 def checks_terminate_message(msg):
     if isinstance(msg, str):
@@ -15,6 +22,25 @@ def checks_terminate_message(msg):
         raise NotImplementedError
     
 
+class EventIOStream(IOConsole):
+    """
+    Console IO stream that also forwards the streamed completion chunks of the planner to an event queue.
+    autogen prints streamed chunks with `end=""`, everything else it prints is regular console output.
+    """
+
+    ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+    def __init__(self, events: queue.Queue):
+        self.events = events
+
+    def print(self, *objects, sep=" ", end="\n", flush=False):
+        if end == "":
+            content = self.ANSI_ESCAPE.sub("", sep.join(map(str, objects)))
+            if content:
+                self.events.put({"type": "token", "content": content})
+        super().print(*objects, sep=sep, end=end, flush=flush)
+
+
 class CustomUserProxyAgent(ConversableAgent):
     """(In preview) A proxy agent for the user, that can execute code and provide feedback to the other agents.
 
@@ -125,6 +151,18 @@ class CapAgent(CustomUserProxyAgent):
         self.prompt_generator = prompt_generator
         self.parser = parser
         self.executor = executor
+        # set by initiate_chat_stream while a streamed chat is running
+        self._events = None
+        self._stop = None
+
+    def _emit(self, event_type: str, **event):
+        if self._events is not None:
+            self._events.put({"type": event_type, **event})
+
+    def send(self, message, recipient, request_reply=None, silent=False):
+        if isinstance(message, str) and message.startswith("OBSERVATION"):
+            self._emit("message", role="user", content=message)
+        return super().send(message, recipient, request_reply=request_reply, silent=silent)
         
     def sender_hits_max_reply(self, sender: Agent):
         return self._consecutive_auto_reply_counter[sender.name] >= self._max_consecutive_auto_reply
@@ -144,6 +182,12 @@ class CapAgent(CustomUserProxyAgent):
         print("COUNTER:", self._consecutive_auto_reply_counter[sender.name])
 
         self._process_received_message(message, sender, silent)
+
+        # the consumer of a streamed chat went away, do not run any further ACTION
+        if self._stop is not None and self._stop.is_set():
+            return
+
+        self._emit("message", role="assistant", content=message['content'] if isinstance(message, dict) else message)
         
         # parsing the code component, if there is one
         parsed_results = self.parser.parse(message)
@@ -196,25 +240,40 @@ class CapAgent(CustomUserProxyAgent):
                 return
     
     def generate_init_message(self, query, n_image, cot_examples):  
-        content = self.prompt_generator.initial_prompt(query, n_image, cot_examples)
+        # the images of this session live in the executor's scratch directory
+        images_dir = getattr(self.executor, "images_dir", None)
+        content = self.prompt_generator.initial_prompt(query, n_image, cot_examples, images_dir=images_dir)
         return content
     
     def get_cot_examples(self, query_str: str):
+        if COT_EXAMPLES_ROUTING:
+            cot_examples = route_cot_examples(query_str, top_k=2)
+            if cot_examples is not None:
+                return cot_examples
+
+        if COT_EXAMPLES_RETRIEVAL == "hybrid":
+            return "\n".join(load_hybrid_index("cot_examples").query(query_str, top_k=2))
+
+        if COT_EXAMPLES_RETRIEVAL == "dense":
+            example_index = load_example_index("cot_examples")
+            return "\n".join(query_example_index(example_index, query_str, similarity_top_k=2))
+
         vector_store = load_vector_store("cot_examples")
         query_result = query_vector_store(vector_store, query_str, "default", similarity_top_k=2)
         cot_examples = "\n".join([node.text for node in query_result.nodes])
         return cot_examples
 
-    def initiate_chat(self, assistant, message, n_image=0, log_prompt_only=False, use_rag=True):
+    def initiate_chat(self, assistant, message, n_image=0, log_prompt_only=False, use_rag=True, cot_examples=None):
 
         self.feedback_types = []
         
-        if use_rag:
+        # cot_examples may have been retrieved ahead of time, e.g. by `batch_retrieve_cot_examples` for a whole batch
+        if cot_examples is None and use_rag:
             print("Using RAG to get CoT examples ...")
             print(f"Query string: {message}")
             cot_examples = self.get_cot_examples(message)
             print(f"Retrieved CoT examples: \n{cot_examples}")
-        else:
+        elif cot_examples is None:
             cot_examples = ""
         
         initial_message = self.generate_init_message(message, n_image, cot_examples)
@@ -228,6 +287,51 @@ class CapAgent(CustomUserProxyAgent):
         result = self.result_parser(self._oai_messages[assistant][-1]['content'])
         return result, chain_of_thought
     
+    def initiate_chat_stream(self, assistant, message, n_image=0, use_rag=True, on_done: Callable[[], None] = None) -> Iterator[Dict]:
+        """
+        Run `initiate_chat` in a background thread and yield its events as they happen:
+            {"type": "token", "content": ...}: a streamed chunk of the planner's completion
+                (only if the planner's llm_config has "stream": True)
+            {"type": "message", "role": "assistant", "content": ...}: a full THOUGHT/ACTION message of the planner
+            {"type": "message", "role": "user", "content": ...}: an OBSERVATION sent back to the planner
+            {"type": "result", "content": ..., "messages": ...}: the final answer and chain of thought
+            {"type": "error", "content": ...}: the chat failed
+
+        If the consumer stops early, e.g. a disconnected client, the chat stops at its next message and the
+        generator returns without waiting for it. `on_done` is called by the chat thread once the chat has ended,
+        e.g. to release the executor it was using.
+        """
+        events = queue.Queue()
+        finished = object()
+        stop = threading.Event()
+
+        def _run():
+            self._events = events
+            self._stop = stop
+            try:
+                with IOStream.set_default(EventIOStream(events)):
+                    result, chain_of_thought = self.initiate_chat(assistant, message, n_image=n_image, use_rag=use_rag)
+                events.put({"type": "result", "content": result, "messages": chain_of_thought})
+            except Exception as e:
+                events.put({"type": "error", "content": f"{type(e).__name__}: {e}"})
+            finally:
+                self._events = None
+                self._stop = None
+                if on_done is not None:
+                    on_done()
+                events.put(finished)
+
+        thread = threading.Thread(target=_run, daemon=True)
+        thread.start()
+        try:
+            while True:
+                event = events.get()
+                if event is finished:
+                    return
+                yield event
+        finally:
+            stop.set()
+
     def result_parser(self, result):
         result = result.split("ANSWER:")[1].replace("TERMINATE", "").strip()
         return result
@@ -0,0 +1,112 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+def make_cache_key(*parts) -> str:
+    """Content-addressed key of any JSON-serializable parts."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    A two-tier key-value cache: an in-memory LRU in front of an optional SQLite file.
+
+    Values are bytes. Entries expire after `ttl` seconds (None keeps them forever), and each tier
+    evicts its least recently used entries once it holds more than its maximum number of items.
+    The SQLite tier can be shared by several processes, e.g. the kernels of the executor pool.
+    """
+
+    def __init__(self, path: str = None, max_memory_items: int = 1024, max_disk_items: int = 100_000, ttl: float = None):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl = ttl
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes_since_eviction = 0
+
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+
+    def _expired(self, created_at, now):
+        return self.ttl is not None and now - created_at > self.ttl
+
+    def get(self, key: str):
+        """Return the cached bytes of `key`, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created_at, value = entry
+                if not self._expired(created_at, now):
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+            if self._db is None:
+                return None
+
+            row = self._db.execute("SELECT value, created_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self._expired(created_at, now):
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return None
+
+            self._db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._set_memory(key, created_at, value)
+            return value
+
+    def set(self, key: str, value: bytes):
+        now = time.time()
+        with self._lock:
+            self._set_memory(key, now, value)
+            if self._db is None:
+                return
+
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            # evicting needs a full count, so only do it every few hundred writes
+            self._writes_since_eviction += 1
+            if self._writes_since_eviction >= 256:
+                self._writes_since_eviction = 0
+                self._evict_disk(now)
+
+    def _set_memory(self, key, created_at, value):
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now):
+        if self.ttl is not None:
+            self._db.execute("DELETE FROM cache WHERE created_at < ?", (now - self.ttl,))
+        count = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        if count > self.max_disk_items:
+            self._db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_disk_items,)
+            )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache")
@@ -1,19 +1,142 @@
 import os
+import json
+import time
+import asyncio
+import weakref
+import threading
 import concurrent.futures
-from openai import OpenAI
+import httpx
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
 from tqdm import tqdm
 import PIL.Image
 import gradio_client
 
+from capagent.cache import TieredCache, make_cache_key
+from capagent.chat_models.router import ModelRouter
+from capagent.chat_models.hedging import Hedger
+from capagent.chat_models.rate_limit import RateLimiter, estimate_tokens
+from capagent.config import (
+    COMPLETION_CACHE_PATH,
+    COMPLETION_CACHE_TTL,
+    COMPLETION_CACHE_MAX_ITEMS,
+    HEDGE_CHAT_REQUESTS,
+    HEDGE_LATENCY_PERCENTILE,
+    RATE_LIMIT_REQUESTS_PER_MINUTE,
+    RATE_LIMIT_TOKENS_PER_MINUTE,
+    RATE_LIMIT_KEY_REQUESTS_PER_MINUTE,
+    RATE_LIMIT_MAX_WAIT
+)
+
+
+# ------------------ Shared async connection pool ------------------
+# httpx connections are bound to the event loop that opened them, so keep one pool per loop
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_http_client():
+    """Return the connection pool shared by all async chat clients on the running event loop."""
+    loop = asyncio.get_running_loop()
+    http_client = _async_http_clients.get(loop)
+    if http_client is None:
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=512, max_keepalive_connections=128)
+        )
+        _async_http_clients[loop] = http_client
+    return http_client
+
+
+# ------------------ Completion cache ------------------
+_completion_cache = None
+_completion_cache_lock = threading.Lock()
+
+
+def get_completion_cache():
+    """Return the process-wide completion cache shared by the chat clients."""
+    global _completion_cache
+    with _completion_cache_lock:
+        if _completion_cache is None:
+            _completion_cache = TieredCache(
+                path=COMPLETION_CACHE_PATH,
+                max_disk_items=COMPLETION_CACHE_MAX_ITEMS,
+                ttl=COMPLETION_CACHE_TTL
+            )
+    return _completion_cache
+
+
+def _request_key(cache, kind, payload, temperature, max_tokens):
+    # only greedy (temperature 0) completions are deterministic enough to be replayed
+    if cache is None or temperature != 0:
+        return None
+    # hash the (possibly large, e.g. base64 images) request once, per-model keys derive from the digest
+    return make_cache_key(kind, payload, temperature, max_tokens)
+
+
+def _cache_lookup(cache, models, request_key):
+    if request_key is None:
+        return None
+    for model in models:
+        cached = cache.get(make_cache_key(model, request_key))
+        if cached is not None:
+            return json.loads(cached)
+    return None
+
+
+def _cache_store(cache, model, request_key, result):
+    if request_key is not None and result is not None:
+        cache.set(make_cache_key(model, request_key), json.dumps(result).encode("utf-8"))
 
-# ------------------ LLMChatClient with fallback ------------------
-class LLMChatClient:
 
-    def __init__(self, api_key=None, models=None):
+# ------------------ Rate limiter ------------------
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter():
+    """Return the process-wide rate limiter shared by the chat clients and their threads."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter(
+                requests_per_minute=RATE_LIMIT_REQUESTS_PER_MINUTE,
+                tokens_per_minute=RATE_LIMIT_TOKENS_PER_MINUTE,
+                key_requests_per_minute=RATE_LIMIT_KEY_REQUESTS_PER_MINUTE,
+                max_wait=RATE_LIMIT_MAX_WAIT
+            )
+    return _rate_limiter
+
+
+async def gather_with_concurrency(coros, max_concurrency=64, return_exceptions=False):
+    """
+    Like `asyncio.gather`, but at most `max_concurrency` of the coroutines run at the same time.
+    Results are returned in the order of `coros`.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _bounded(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*[_bounded(coro) for coro in coros], return_exceptions=return_exceptions)
+
+
+# ------------------ Chat clients with fallback ------------------
+class _FallbackChatClient:
+    """
+    OpenRouter chat client that falls back through `models`, shared by `LLMChatClient` and `MLLMChatClient`.
+    `error_message` starts the error raised when every model failed.
+    """
+
+    error_message = "All models failed."
+
+    def __init__(self, api_key=None, models=None, cache=None, hedge=HEDGE_CHAT_REQUESTS):
+        self.api_key = api_key or os.environ.get("OPENROUTER_API_KEY")
         self.client = OpenAI(
             base_url="https://openrouter.ai/api/v1",
-            api_key=api_key or os.environ.get("OPENROUTER_API_KEY")
+            api_key=self.api_key
         )
+        self._async_clients = weakref.WeakKeyDictionary()
+        # pass cache=False to disable caching of completions
+        self.cache = get_completion_cache() if cache is None else (cache or None)
         # List of free fallback models (you can extend this)
         self.models = models or [
             "deepseek/deepseek-chat-v3-0324:free",
@@ -21,18 +144,101 @@ class LLMChatClient:
             "nousresearch/nous-capybara-7b:free",
             "mistralai/mistral-7b-instruct:free"
         ]
+        # orders self.models by recent latency and errors, and skips models with an open circuit
+        self.router = ModelRouter(self.models)
+        # optionally race the next model against a slow one, see `hedger.stats` for how often it helps
+        self.hedger = Hedger(self.router, percentile=HEDGE_LATENCY_PERCENTILE) if hedge else None
+        self.rate_limiter = get_rate_limiter()
+
+    def _try_models(self, func, *args, request_key=None, tokens=0, **kwargs):
+        """
+        Try the models in the order chosen by the router until one succeeds.
+        Requests with a `request_key` go through the cache.
+        """
+        cached = _cache_lookup(self.cache, self.models, request_key)
+        if cached is not None:
+            return cached
+
+        candidates = self.router.candidates()
+
+        def _limited_call(model):
+            # a throttled model is skipped for the next one, only the last candidate waits for capacity
+            return self.rate_limiter.call(
+                self.api_key, model, tokens, lambda: func(model, *args, **kwargs), fail_fast=model != candidates[-1]
+            )
+
+        if self.hedger is not None:
+            model, result = self.hedger.run(_limited_call, candidates, self.error_message)
+            _cache_store(self.cache, model, request_key, result)
+            return result
+
+        last_error = None
+        for model in candidates:
+            start = time.monotonic()
+            try:
+                print(f"🔄 Trying model: {model}")
+                result = _limited_call(model)
+            except Exception as e:
+                self.router.record_failure(model, time.monotonic() - start, e)
+                print(f"⚠️ Model {model} failed: {e}")
+                last_error = e
+            else:
+                self.router.record_success(model, time.monotonic() - start)
+                _cache_store(self.cache, model, request_key, result)
+                return result
+        raise RuntimeError(f"{self.error_message} Last error: {last_error}")
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client of the running event loop, backed by the shared connection pool."""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = AsyncOpenAI(
+                base_url="https://openrouter.ai/api/v1",
+                api_key=self.api_key,
+                http_client=get_async_http_client()
+            )
+            self._async_clients[loop] = client
+        return client
+
+    async def _atry_models(self, func, *args, request_key=None, tokens=0, **kwargs):
+        """Async version of `_try_models`."""
+        cached = _cache_lookup(self.cache, self.models, request_key)
+        if cached is not None:
+            return cached
+
+        candidates = self.router.candidates()
+
+        async def _limited_call(model):
+            return await self.rate_limiter.acall(
+                self.api_key, model, tokens, lambda: func(model, *args, **kwargs), fail_fast=model != candidates[-1]
+            )
+
+        if self.hedger is not None:
+            model, result = await self.hedger.arun(_limited_call, candidates, self.error_message)
+            _cache_store(self.cache, model, request_key, result)
+            return result
 
-    def _try_models(self, func, *args, **kwargs):
-        """Try all models in fallback order until success."""
         last_error = None
-        for model in self.models:
+        for model in candidates:
+            start = time.monotonic()
             try:
                 print(f"🔄 Trying model: {model}")
-                return func(model, *args, **kwargs)
+                result = await _limited_call(model)
             except Exception as e:
+                self.router.record_failure(model, time.monotonic() - start, e)
                 print(f"⚠️ Model {model} failed: {e}")
                 last_error = e
-        raise RuntimeError(f"All models failed. Last error: {last_error}")
+            else:
+                self.router.record_success(model, time.monotonic() - start)
+                _cache_store(self.cache, model, request_key, result)
+                return result
+        raise RuntimeError(f"{self.error_message} Last error: {last_error}")
+
+
+# ------------------ LLMChatClient with fallback ------------------
+class LLMChatClient(_FallbackChatClient):
 
     def text_completion(self, prompt, temperature=0, max_tokens=512):
         def _call(model, prompt, temperature, max_tokens):
@@ -44,7 +250,11 @@ class LLMChatClient:
             )
             return resp.choices[0].text
 
-        return self._try_models(_call, prompt, temperature, max_tokens)
+        request_key = _request_key(self.cache, "text", prompt, temperature, max_tokens)
+        return self._try_models(
+            _call, prompt, temperature, max_tokens,
+            request_key=request_key, tokens=estimate_tokens(prompt, max_tokens)
+        )
 
     def chat_completion(self, messages, temperature=0, max_tokens=1024):
         def _call(model, messages, temperature, max_tokens):
@@ -56,7 +266,43 @@ class LLMChatClient:
             )
             return resp.choices[0].message.content
 
-        return self._try_models(_call, messages, temperature, max_tokens)
+        request_key = _request_key(self.cache, "chat", messages, temperature, max_tokens)
+        return self._try_models(
+            _call, messages, temperature, max_tokens,
+            request_key=request_key, tokens=estimate_tokens(messages, max_tokens)
+        )
+
+    async def atext_completion(self, prompt, temperature=0, max_tokens=512):
+        async def _call(model, prompt, temperature, max_tokens):
+            resp = await self.async_client.completions.create(
+                model=model,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+            return resp.choices[0].text
+
+        request_key = _request_key(self.cache, "text", prompt, temperature, max_tokens)
+        return await self._atry_models(
+            _call, prompt, temperature, max_tokens,
+            request_key=request_key, tokens=estimate_tokens(prompt, max_tokens)
+        )
+
+    async def achat_completion(self, messages, temperature=0, max_tokens=1024):
+        async def _call(model, messages, temperature, max_tokens):
+            resp = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+            )
+            return resp.choices[0].message.content
+
+        request_key = _request_key(self.cache, "chat", messages, temperature, max_tokens)
+        return await self._atry_models(
+            _call, messages, temperature, max_tokens,
+            request_key=request_key, tokens=estimate_tokens(messages, max_tokens)
+        )
 
     def handle_text_completion(self, request):
         return {"id": request['id'], "result": self.text_completion(request['prompt'])}
@@ -80,32 +326,22 @@ class LLMChatClient:
                     pbar.update(1)
         return results
 
+    async def aprocess_requests(self, requests, max_parallel_requests=64):
+        """Async version of `process_requests_multithreaded`, without one thread per in-flight request."""
 
-# ------------------ MLLMChatClient with fallback ------------------
-class MLLMChatClient:
+        async def _handle(request):
+            if request['type'] == 'text':
+                return {"id": request['id'], "result": await self.atext_completion(request['prompt'])}
+            return {"id": request['id'], "result": await self.achat_completion(request['messages'])}
 
-    def __init__(self, api_key=None, models=None):
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key or os.environ.get("OPENROUTER_API_KEY")
-        )
-        self.models = models or [
-            "deepseek/deepseek-chat-v3-0324:free",
-            "qwen/qwen2.5-7b-instruct:free",
-            "nousresearch/nous-capybara-7b:free",
-            "mistralai/mistral-7b-instruct:free"
-        ]
+        requests = [request for request in requests if request['type'] in ('text', 'chat')]
+        return await gather_with_concurrency([_handle(request) for request in requests], max_parallel_requests)
 
-    def _try_models(self, func, *args, **kwargs):
-        last_error = None
-        for model in self.models:
-            try:
-                print(f"🔄 Trying model: {model}")
-                return func(model, *args, **kwargs)
-            except Exception as e:
-                print(f"⚠️ Model {model} failed: {e}")
-                last_error = e
-        raise RuntimeError(f"All multimodal models failed. Last error: {last_error}")
+
+# ------------------ MLLMChatClient with fallback ------------------
+class MLLMChatClient(_FallbackChatClient):
+
+    error_message = "All multimodal models failed."
 
     def chat_completion(self, messages, temperature=0, max_tokens=512, timeout=None):
         def _call(model, messages, temperature, max_tokens, timeout):
@@ -118,7 +354,28 @@ class MLLMChatClient:
             )
             return resp.choices[0].message.content
 
-        return self._try_models(_call, messages, temperature, max_tokens, timeout)
+        request_key = _request_key(self.cache, "chat", messages, temperature, max_tokens)
+        return self._try_models(
+            _call, messages, temperature, max_tokens, timeout,
+            request_key=request_key, tokens=estimate_tokens(messages, max_tokens)
+        )
+
+    async def achat_completion(self, messages, temperature=0, max_tokens=512, timeout=None):
+        async def _call(model, messages, temperature, max_tokens, timeout):
+            resp = await self.async_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                timeout=timeout
+            )
+            return resp.choices[0].message.content
+
+        request_key = _request_key(self.cache, "chat", messages, temperature, max_tokens)
+        return await self._atry_models(
+            _call, messages, temperature, max_tokens, timeout,
+            request_key=request_key, tokens=estimate_tokens(messages, max_tokens)
+        )
 
 
 
@@ -166,6 +423,17 @@ def test_multithreaded_requests():
     for result in results:
         print(result)
 
+def test_async_requests():
+    requests = [
+        {"id": i, "type": "chat", "messages": [{"role": "user", "content": f"What is {i} + {i}?"}]}
+        for i in range(16)
+    ]
+
+    results = asyncio.run(llm_client.aprocess_requests(requests, max_parallel_requests=8))
+
+    for result in results:
+        print(result)
+
 
 if __name__ == "__main__":
 
@@ -174,5 +442,6 @@ if __name__ == "__main__":
 
     test_single_image_chat_completion()
     test_multithreaded_requests()
+    test_async_requests()
 
     
@@ -0,0 +1,180 @@
+import time
+import asyncio
+import threading
+import concurrent.futures
+
+
+class HedgeStats:
+    """Counters of how often hedged requests fire and how often the hedge answers first."""
+
+    def __init__(self):
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self._lock = threading.Lock()
+
+    def record(self, hedges_fired, hedge_won):
+        with self._lock:
+            self.requests += 1
+            self.hedges_fired += hedges_fired
+            self.hedges_won += int(hedge_won)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges_fired": self.hedges_fired,
+                "hedges_won": self.hedges_won,
+                "hedge_rate": self.hedges_fired / self.requests if self.requests else 0.0,
+                "hedge_win_rate": self.hedges_won / self.hedges_fired if self.hedges_fired else 0.0,
+            }
+
+
+class Hedger:
+    """
+    Sends a request to the next fallback model when the current one is slow, and keeps the first answer.
+
+    The hedge delay of a model is the `percentile`-th percentile of its recent successful latencies,
+    as tracked by the router, or `default_delay` while the model has no history. At most
+    `max_hedges` extra requests are sent per call. A model that fails before its delay is replaced by
+    the next candidate as in plain fallback, without counting as a hedge.
+    Losing async requests are cancelled; losing blocking requests cannot be interrupted, their
+    answer is simply discarded.
+    """
+
+    def __init__(self, router, percentile: float = 95, default_delay: float = 10, min_delay: float = 0.5, max_hedges: int = 1, max_workers: int = 32):
+        self.router = router
+        self.percentile = percentile
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_hedges = max_hedges
+        self.stats = HedgeStats()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+
+    def delay(self, model):
+        latency = self.router.latency_percentile(model, self.percentile)
+        return self.default_delay if latency is None else max(latency, self.min_delay)
+
+    def _timed(self, func, model):
+        start = time.monotonic()
+        try:
+            return func(model), time.monotonic() - start
+        except Exception as e:
+            e.latency = time.monotonic() - start
+            raise
+
+    def run(self, func, candidates, error_message="All models failed."):
+        """
+        Call `func(model)` on `candidates` with hedging, and return `(model, result)` of the first success.
+        Raises a RuntimeError starting with `error_message` when every model failed.
+        """
+        candidates = iter(candidates)
+        pending = {}  # future -> (model, is_hedge)
+        hedges_fired = 0
+        exhausted = False
+        last_error = None
+
+        def _launch(is_hedge):
+            model = next(candidates, None)
+            if model is None:
+                return False
+            print(f"🔄 Trying model: {model}" + (" (hedge)" if is_hedge else ""))
+            pending[self._pool.submit(self._timed, func, model)] = (model, is_hedge)
+            return True
+
+        _launch(False)
+        while pending:
+            newest_model = list(pending.values())[-1][0]
+            timeout = self.delay(newest_model) if hedges_fired < self.max_hedges and not exhausted else None
+            done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+
+            if not done:
+                if _launch(True):
+                    hedges_fired += 1
+                else:
+                    # nothing left to hedge with, just wait for the requests in flight
+                    exhausted = True
+                continue
+
+            for future in done:
+                model, is_hedge = pending.pop(future)
+                try:
+                    result, latency = future.result()
+                except Exception as e:
+                    self.router.record_failure(model, getattr(e, "latency", 0.0), e)
+                    print(f"⚠️ Model {model} failed: {e}")
+                    last_error = e
+                    continue
+
+                self.router.record_success(model, latency)
+                for loser in pending:
+                    loser.cancel()
+                self.stats.record(hedges_fired, is_hedge)
+                return model, result
+
+            if not pending:
+                _launch(False)
+
+        self.stats.record(hedges_fired, False)
+        raise RuntimeError(f"{error_message} Last error: {last_error}")
+
+    async def _atimed(self, func, model):
+        start = time.monotonic()
+        try:
+            return await func(model), time.monotonic() - start
+        except Exception as e:
+            e.latency = time.monotonic() - start
+            raise
+
+    async def arun(self, func, candidates, error_message="All models failed."):
+        """Async version of `run`, for coroutine functions. Losing requests are cancelled."""
+        candidates = iter(candidates)
+        pending = {}  # task -> (model, is_hedge)
+        hedges_fired = 0
+        exhausted = False
+        last_error = None
+
+        def _launch(is_hedge):
+            model = next(candidates, None)
+            if model is None:
+                return False
+            print(f"🔄 Trying model: {model}" + (" (hedge)" if is_hedge else ""))
+            pending[asyncio.ensure_future(self._atimed(func, model))] = (model, is_hedge)
+            return True
+
+        _launch(False)
+        try:
+            while pending:
+                newest_model = list(pending.values())[-1][0]
+                timeout = self.delay(newest_model) if hedges_fired < self.max_hedges and not exhausted else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    if _launch(True):
+                        hedges_fired += 1
+                    else:
+                        exhausted = True
+                    continue
+
+                for task in done:
+                    model, is_hedge = pending.pop(task)
+                    try:
+                        result, latency = task.result()
+                    except Exception as e:
+                        self.router.record_failure(model, getattr(e, "latency", 0.0), e)
+                        print(f"⚠️ Model {model} failed: {e}")
+                        last_error = e
+                        continue
+
+                    self.router.record_success(model, latency)
+                    self.stats.record(hedges_fired, is_hedge)
+                    return model, result
+
+                if not pending:
+                    _launch(False)
+        finally:
+            for task in pending:
+                task.cancel()
+
+        self.stats.record(hedges_fired, False)
+        raise RuntimeError(f"{error_message} Last error: {last_error}")
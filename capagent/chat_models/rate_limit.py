@@ -0,0 +1,163 @@
+import time
+import asyncio
+import hashlib
+import threading
+
+from capagent.chat_models.router import is_rate_limited, retry_after
+
+
+# rough size of an image in the prompt, counted instead of the length of its base64 data
+IMAGE_TOKENS = 1000
+
+
+def estimate_tokens(payload, max_tokens):
+    """Cheap upper-bound estimate of the tokens a completion request consumes (~4 characters per token)."""
+    if isinstance(payload, str):
+        return len(payload) // 4 + max_tokens
+
+    n_chars, n_images = 0, 0
+    for message in payload:
+        content = message.get("content") or ""
+        if isinstance(content, str):
+            n_chars += len(content)
+            continue
+        for part in content:
+            if part.get("type") == "text":
+                n_chars += len(part.get("text", ""))
+            else:
+                n_images += 1
+    return n_chars // 4 + n_images * IMAGE_TOKENS + max_tokens
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate_per_minute`, holding at most `capacity` (default: one minute of refill).
+
+    `reserve` takes the tokens right away, even if that drives the bucket negative, and returns how long
+    the caller has to wait for them. Later callers therefore queue behind earlier ones.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available, without taking them."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def reserve(self, amount):
+        wait = self.wait_time(amount)
+        self.tokens -= amount
+        return wait
+
+
+class RateLimitExceeded(RuntimeError):
+    """
+    Raised instead of waiting when a model is held back by the client-side rate limiter.
+    Looks like a 429 to the router, so it falls back to the next model.
+    """
+
+    status_code = 429
+
+    def __init__(self, model, retry_after):
+        super().__init__(f"Client-side rate limit of {model}, retry in {retry_after:.1f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+    """
+    Client-side rate limiter shared by all chat clients of a process.
+
+    Each (API key, model) pair gets a requests-per-minute and an optional tokens-per-minute bucket, and
+    each API key an optional requests-per-minute bucket over all of its models. A 429 blocks the model
+    for its `Retry-After` (or `default_retry_after`) seconds, so other threads stop sending requests
+    that are bound to fail.
+
+    With `fail_fast`, a call to a blocked model, or one that would wait more than `max_wait` seconds,
+    raises `RateLimitExceeded` without taking any capacity, so the caller can try another model instead.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, key_requests_per_minute=None, default_retry_after=10.0, max_wait=2.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.key_requests_per_minute = key_requests_per_minute
+        self.default_retry_after = default_retry_after
+        self.max_wait = max_wait
+        self._buckets = {}
+        self._blocked_until = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key_id(api_key):
+        # never keep the raw key around
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+    def _bucket(self, name, rate):
+        if name not in self._buckets:
+            self._buckets[name] = TokenBucket(rate)
+        return self._buckets[name]
+
+    def reserve(self, api_key, model, tokens=0, fail_fast=False):
+        """
+        Reserve capacity for one request and return how many seconds to wait before sending it.
+        With `fail_fast`, raise `RateLimitExceeded` instead if the model is blocked or the wait exceeds `max_wait`.
+        """
+        key_id = self._key_id(api_key)
+        with self._lock:
+            demands = []
+            if self.requests_per_minute:
+                demands.append((self._bucket((key_id, model, "requests"), self.requests_per_minute), 1))
+            if self.tokens_per_minute and tokens:
+                demands.append((self._bucket((key_id, model, "tokens"), self.tokens_per_minute), tokens))
+            if self.key_requests_per_minute:
+                demands.append((self._bucket((key_id, None, "requests"), self.key_requests_per_minute), 1))
+
+            blocked = self._blocked_until.get((key_id, model), 0.0) - time.monotonic()
+            wait = max([0.0, blocked] + [bucket.wait_time(amount) for bucket, amount in demands])
+            if fail_fast and (blocked > 0 or wait > self.max_wait):
+                raise RateLimitExceeded(model, wait)
+
+            for bucket, amount in demands:
+                bucket.reserve(amount)
+        return wait
+
+    def penalize(self, api_key, model, seconds):
+        """Hold back all requests to `model` for `seconds`, e.g. after a 429."""
+        name = (self._key_id(api_key), model)
+        with self._lock:
+            self._blocked_until[name] = max(self._blocked_until.get(name, 0.0), time.monotonic() + seconds)
+
+    def _on_error(self, api_key, model, error):
+        if is_rate_limited(error):
+            wait = retry_after(error)
+            self.penalize(api_key, model, self.default_retry_after if wait is None else wait)
+
+    def call(self, api_key, model, tokens, func, fail_fast=False):
+        """Wait for capacity, then call `func()`. See `reserve` for `fail_fast`."""
+        wait = self.reserve(api_key, model, tokens, fail_fast)
+        if wait > 0:
+            print(f"⏳ Rate limit: waiting {wait:.1f}s for {model}")
+            time.sleep(wait)
+        try:
+            return func()
+        except Exception as e:
+            self._on_error(api_key, model, e)
+            raise
+
+    async def acall(self, api_key, model, tokens, func, fail_fast=False):
+        """Async version of `call`, for a coroutine function."""
+        wait = self.reserve(api_key, model, tokens, fail_fast)
+        if wait > 0:
+            print(f"⏳ Rate limit: waiting {wait:.1f}s for {model}")
+            await asyncio.sleep(wait)
+        try:
+            return await func()
+        except Exception as e:
+            self._on_error(api_key, model, e)
+            raise
@@ -0,0 +1,139 @@
+import time
+import threading
+from collections import deque
+
+
+def is_rate_limited(error) -> bool:
+    """Whether an API error is a 429 response."""
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after(error):
+    """Seconds to wait according to the `Retry-After` header of an API error, or None."""
+    if getattr(error, "retry_after", None) is not None:
+        # e.g. `RateLimitExceeded` of the client-side rate limiter
+        return error.retry_after
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        return max(float(headers.get("retry-after")), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class _ModelHealth:
+
+    def __init__(self, window_size):
+        # (timestamp, latency, ok, rate_limited) of the most recent calls
+        self.calls = deque(maxlen=window_size)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.cooldown = 0.0
+
+
+class ModelRouter:
+    """
+    Orders the fallback models of a chat client by their recent health.
+
+    For every model the router keeps a sliding window of call outcomes. A model whose circuit is
+    open (after `failure_threshold` consecutive failures, or a 429) is skipped until its cooldown
+    has passed (or the `Retry-After` of the 429); the cooldown doubles each time the circuit
+    re-opens, up to `max_cooldown`. The remaining models are ordered by expected latency: the mean
+    latency of their successful calls, blended by the error rate with the time a failure wastes.
+    """
+
+    def __init__(
+        self,
+        models,
+        window_size: int = 50,
+        window_seconds: float = 300,
+        failure_threshold: int = 3,
+        cooldown: float = 30,
+        max_cooldown: float = 600,
+        default_latency: float = 30,
+    ):
+        self.models = list(models)
+        self.window_seconds = window_seconds
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # expected latency of a model without recent calls, keeps untried models behind healthy ones
+        self.default_latency = default_latency
+        self._health = {model: _ModelHealth(window_size) for model in self.models}
+        self._lock = threading.Lock()
+
+    def _recent_calls(self, health, now):
+        return [call for call in health.calls if now - call[0] <= self.window_seconds]
+
+    def _expected_latency(self, health, now):
+        calls = self._recent_calls(health, now)
+        if not calls:
+            return self.default_latency
+        successes = [latency for _, latency, ok, _ in calls if ok]
+        failures = [latency for _, latency, ok, _ in calls if not ok]
+        success_latency = sum(successes) / len(successes) if successes else self.default_latency
+        failure_latency = sum(failures) / len(failures) if failures else 0.0
+        error_rate = len(failures) / len(calls)
+        # a failure costs its own latency plus falling back to some other model
+        return (1 - error_rate) * success_latency + error_rate * (failure_latency + self.default_latency)
+
+    def candidates(self):
+        """
+        Models to try for the next request, in order. Models with an open circuit are left out;
+        if every circuit is open, all models are returned ordered by the time they re-open.
+        """
+        now = time.time()
+        with self._lock:
+            closed = [model for model in self.models if self._health[model].open_until <= now]
+            if not closed:
+                return sorted(self.models, key=lambda model: self._health[model].open_until)
+            # sorted() is stable, so models without data keep their configured order
+            return sorted(closed, key=lambda model: self._expected_latency(self._health[model], now))
+
+    def record_success(self, model, latency):
+        with self._lock:
+            health = self._health[model]
+            health.calls.append((time.time(), latency, True, False))
+            health.consecutive_failures = 0
+            health.cooldown = 0.0
+
+    def record_failure(self, model, latency, error=None):
+        now = time.time()
+        rate_limited = is_rate_limited(error)
+        with self._lock:
+            health = self._health[model]
+            health.calls.append((now, latency, False, rate_limited))
+            health.consecutive_failures += 1
+
+            if rate_limited or health.consecutive_failures >= self.failure_threshold:
+                health.cooldown = min(max(health.cooldown * 2, self.base_cooldown), self.max_cooldown)
+                wait = retry_after(error) if rate_limited else None
+                health.open_until = now + (wait if wait is not None else health.cooldown)
+
+    def latency_percentile(self, model, q):
+        """The `q`-th percentile (0-100) of the recent successful latencies of `model`, or None."""
+        now = time.time()
+        with self._lock:
+            latencies = sorted(latency for _, latency, ok, _ in self._recent_calls(self._health[model], now) if ok)
+        if not latencies:
+            return None
+        index = min(int(round(q / 100 * (len(latencies) - 1))), len(latencies) - 1)
+        return latencies[index]
+
+    def stats(self):
+        """Per-model summary of the sliding window, for logging."""
+        now = time.time()
+        stats = {}
+        with self._lock:
+            for model, health in self._health.items():
+                calls = self._recent_calls(health, now)
+                stats[model] = {
+                    "calls": len(calls),
+                    "error_rate": sum(not ok for _, _, ok, _ in calls) / len(calls) if calls else 0.0,
+                    "rate_limited": sum(limited for _, _, _, limited in calls),
+                    "expected_latency": self._expected_latency(health, now),
+                    "circuit_open": health.open_until > now,
+                }
+        return stats
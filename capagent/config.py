@@ -1,4 +1,68 @@
+import os
+
 IMAGE_SERVER_DOMAIN_NAME = "https://i.ibb.co"
 DETECTION_CLIENT_HOST = "http://127.0.0.1:8080"
 DEPTH_CLIENT_HOST = "http://127.0.0.1:7860"
 #DEPTH_CLIENT_HOST = "http://127.0.0.1:8081"
+
+# Cache of detection results by detector version, image content, caption and thresholds, set CAPAGENT_DETECTION_CACHE
+# to an empty string to keep it in memory only
+DETECTION_CACHE_PATH = os.environ.get(
+    "CAPAGENT_DETECTION_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "detections.sqlite")
+) or None
+DETECTION_CACHE_TTL = 7 * 24 * 3600
+DETECTION_CACHE_MAX_ITEMS = 100_000
+
+# Number of warm code executors (kernel processes) shared by concurrent agent sessions
+EXECUTOR_POOL_SIZE = 4
+
+# Cache of temperature-0 LLM/MLLM completions, set CAPAGENT_COMPLETION_CACHE to an empty string to keep it in memory only
+COMPLETION_CACHE_PATH = os.environ.get(
+    "CAPAGENT_COMPLETION_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "completions.sqlite")
+) or None
+COMPLETION_CACHE_TTL = 7 * 24 * 3600
+COMPLETION_CACHE_MAX_ITEMS = 100_000
+
+# Hedged chat requests: send the request to the next model too if the current one is slower than this percentile of its latency
+HEDGE_CHAT_REQUESTS = os.environ.get("CAPAGENT_HEDGE_REQUESTS", "0") == "1"
+HEDGE_LATENCY_PERCENTILE = 95
+
+# Client-side rate limits of the chat clients (None disables a limit). OpenRouter free models allow 20 requests per minute.
+# They apply per model to the calls of `llm_client` and `mllm_client` (the tools), not to the autogen planner in run.py
+RATE_LIMIT_REQUESTS_PER_MINUTE = 20
+RATE_LIMIT_TOKENS_PER_MINUTE = None
+RATE_LIMIT_KEY_REQUESTS_PER_MINUTE = None
+# A model that would wait longer than this many seconds for capacity, or got a 429, is skipped for the next fallback model
+RATE_LIMIT_MAX_WAIT = 2
+
+# How CoT examples are retrieved: "hybrid" (BM25 fused with dense similarity, skipping the embedder when
+# the keywords are conclusive), "dense" (in-memory matrix of the example embeddings) or "chroma"
+COT_EXAMPLES_RETRIEVAL = "hybrid"
+
+# Route queries with recognized constraint types (length, sentiment, ...) straight to matching CoT examples,
+# using the table built by `python -m capagent.example_routing`. Other queries fall back to retrieval
+COT_EXAMPLES_ROUTING = True
+COT_EXAMPLES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cot_examples")
+COT_EXAMPLES_ROUTING_TABLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cot_examples_routing.json")
+
+# Only put the tools relevant to a request (by its constraint types and CoT examples) into the initial prompt
+PRUNE_TOOL_PROMPT = True
+
+# Embedding model of the RAG indexes, loaded on first use. Set CAPAGENT_EMBEDDING_WORKER to "host:port" of a
+# running `python -m capagent.embedding_worker` to share one resident model between processes instead
+EMBEDDING_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+EMBEDDING_WORKER_ADDRESS = os.environ.get("CAPAGENT_EMBEDDING_WORKER") or None
+
+# Backend of the query embedding model: "torch", "onnx" or "onnx-int8" (ONNX Runtime, for CPU-only nodes).
+# ONNX exports are created on first use under EMBEDDING_ONNX_DIR
+EMBEDDING_BACKEND = os.environ.get("CAPAGENT_EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "onnx")
+
+# Cache of query embeddings, set CAPAGENT_EMBEDDING_CACHE to an empty string to keep it in memory only
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "CAPAGENT_EMBEDDING_CACHE",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".cache", "embeddings.sqlite")
+) or None
+EMBEDDING_CACHE_MAX_ITEMS = 100_000
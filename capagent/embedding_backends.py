@@ -0,0 +1,127 @@
+import os
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+from capagent.config import EMBEDDING_MODEL_NAME, EMBEDDING_ONNX_DIR
+
+
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+
+
+def onnx_model_dir(model_name: str, quantize: bool) -> str:
+    return os.path.join(EMBEDDING_ONNX_DIR, model_name.replace("/", "--") + ("-int8" if quantize else ""))
+
+
+def export_onnx_model(model_name: str, quantize: bool = True) -> str:
+    """
+    Export a huggingface embedding model to ONNX once, optionally with dynamic int8 quantization,
+    and return the directory of the exported model.
+    """
+    try:
+        from llama_index.embeddings.huggingface_optimum import OptimumEmbedding
+    except ImportError:
+        raise ImportError(
+            "The onnx embedding backends need `pip install llama-index-embeddings-huggingface-optimum optimum[onnxruntime]`."
+        )
+
+    output_dir = onnx_model_dir(model_name, quantize)
+    if os.path.exists(os.path.join(output_dir, "model.onnx")):
+        return output_dir
+
+    fp32_dir = onnx_model_dir(model_name, quantize=False)
+    if not os.path.exists(os.path.join(fp32_dir, "model.onnx")):
+        print(f"Exporting {model_name} to ONNX ...")
+        OptimumEmbedding.create_and_save_optimum_model(model_name, fp32_dir)
+
+    if quantize:
+        from optimum.onnxruntime import ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+        print(f"Quantizing {model_name} to int8 ...")
+        quantizer = ORTQuantizer.from_pretrained(fp32_dir)
+        quantizer.quantize(save_dir=output_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+        # OptimumEmbedding loads model.onnx and the tokenizer from the same directory
+        os.replace(os.path.join(output_dir, "model_quantized.onnx"), os.path.join(output_dir, "model.onnx"))
+        for name in os.listdir(fp32_dir):
+            if not name.endswith(".onnx") and not os.path.exists(os.path.join(output_dir, name)):
+                shutil.copy(os.path.join(fp32_dir, name), output_dir)
+
+    return output_dir
+
+
+def load_embed_model(backend: str = "torch", model_name: str = EMBEDDING_MODEL_NAME):
+    """
+    Load a llama_index embedding model with the given backend:
+        "torch": full precision PyTorch (HuggingFaceEmbedding)
+        "onnx": ONNX Runtime export of the same model
+        "onnx-int8": ONNX Runtime export with dynamically quantized int8 weights, for CPU-only nodes
+    """
+    if backend == "torch":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+        return HuggingFaceEmbedding(model_name=model_name)
+
+    if backend in ("onnx", "onnx-int8"):
+        folder_name = export_onnx_model(model_name, quantize=backend == "onnx-int8")
+        from llama_index.embeddings.huggingface_optimum import OptimumEmbedding
+        return OptimumEmbedding(folder_name=folder_name)
+
+    raise ValueError(f"Unknown embedding backend: {backend}, expected one of {EMBEDDING_BACKENDS}")
+
+
+def compare_backends(queries: list[str], backend: str, reference_backend: str = "torch", collection_name: str = "cot_examples", top_k: int = 2):
+    """
+    Check a backend against the reference backend on the example collection: recall@k of the
+    retrieved examples, cosine similarity of the query embeddings and the mean query latency.
+    """
+    from capagent.indexing import load_example_index
+
+    example_index = load_example_index(collection_name)
+    report = {}
+    retrieved = {}
+    embeddings = {}
+
+    for name in (reference_backend, backend):
+        embed_model = load_embed_model(name)
+        embed_model.get_query_embedding(queries[0])  # warm up
+
+        start = time.perf_counter()
+        embeddings[name] = np.asarray([embed_model.get_query_embedding(query) for query in queries], dtype=np.float32)
+        report[f"{name}_latency_ms"] = (time.perf_counter() - start) / len(queries) * 1000
+        retrieved[name] = example_index.query_batch(embeddings[name], top_k)
+
+    hits = sum(len(set(ours) & set(theirs)) for ours, theirs in zip(retrieved[backend], retrieved[reference_backend]))
+    report[f"recall@{top_k}"] = hits / sum(len(theirs) for theirs in retrieved[reference_backend])
+
+    a, b = embeddings[reference_backend], embeddings[backend]
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+    report["min_cosine"] = float(cosine.min())
+    report["mean_cosine"] = float(cosine.mean())
+    return report
+
+
+if __name__ == "__main__":
+    from capagent.utils import iter_jsonlines
+
+    parser = argparse.ArgumentParser("Compare an embedding backend against torch", add_help=True)
+    parser.add_argument("--backend", type=str, default="onnx-int8", choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--queries", type=str, default=None, help="JSONL file with a \"query\" per line, e.g. the input of batch_run.py")
+    parser.add_argument("--top_k", type=int, default=2)
+    args = parser.parse_args()
+
+    if args.queries:
+        queries = [record["query"] for record in iter_jsonlines(args.queries)]
+    else:
+        queries = [
+            "Please captioning this image within 10 words.",
+            "Captioning this image with positive sentiment.",
+            "Describe the image in more than 50 words and include the words \"dog\" and \"park\".",
+            "Create a detailed description of the image, maintain neutrality and objectivity.",
+            "Describe this image in no more than one sentence.",
+            "Describe the position of the objects in the image.",
+        ]
+
+    for key, value in compare_backends(queries, args.backend, top_k=args.top_k).items():
+        print(f"{key}: {value:.4f}")
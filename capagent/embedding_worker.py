@@ -0,0 +1,134 @@
+import os
+import argparse
+import threading
+from multiprocessing.connection import Listener, Client
+
+
+AUTHKEY_ENV = "CAPAGENT_EMBEDDING_AUTHKEY"
+
+
+def _handle(conn, embed_model, lock, info):
+    from capagent.indexing import embed_query_batch
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            # one forward pass at a time, the model is shared by all connections
+            with lock:
+                if command == "info":
+                    result = info
+                elif command == "query":
+                    result = embed_model.get_query_embedding(payload)
+                elif command == "query_batch":
+                    result = embed_query_batch(embed_model, payload)
+                elif command == "text_batch":
+                    result = embed_model.get_text_embedding_batch(payload)
+                else:
+                    raise ValueError(f"Unknown embedding command: {command}")
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+    conn.close()
+
+
+def serve_forever(host: str, port: int, model_name: str, authkey: bytes, backend: str = "torch"):
+    """
+    Load the embedding model once and serve embedding requests of other processes.
+
+    Every client connection is handled by its own thread. Requests are `(command, payload)` tuples,
+    `("query", text)`, `("query_batch", texts)` or `("text_batch", texts)`, and each one gets an `(status, result)` reply.
+    `("info", None)` returns the model name and backend the worker embeds with.
+    """
+    from capagent.embedding_backends import load_embed_model
+
+    embed_model = load_embed_model(backend, model_name)
+    lock = threading.Lock()
+    info = {"model_name": model_name, "backend": backend}
+
+    with Listener((host, port), authkey=authkey) as listener:
+        print(f"✅ Embedding worker for {model_name} ({backend}) listening on {host}:{listener.address[1]}", flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # e.g. a client with a wrong authkey
+                print(f"⚠️ Rejected embedding client: {e}")
+                continue
+            threading.Thread(target=_handle, args=(conn, embed_model, lock, info), daemon=True).start()
+
+
+class RemoteEmbedding:
+    """
+    Embedding model living in a resident embedding worker, see `serve_forever`.
+
+    Exposes the embedding methods of the llama_index embedding models used by `capagent.indexing`,
+    so processes sharing one worker do not each load the model.
+    """
+
+    def __init__(self, address: str, authkey: str, model_name: str = None):
+        host, port = address.rsplit(":", 1)
+        self.address = (host, int(port))
+        self.authkey = authkey.encode()
+        self.model_name = model_name
+        self._info = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _request(self, command, payload):
+        with self._lock:
+            # reconnect once if the worker was restarted since the last request
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(self.address, authkey=self.authkey)
+                    self._conn.send((command, payload))
+                    status, result = self._conn.recv()
+                    break
+                except (EOFError, OSError):
+                    self._conn = None
+                    if attempt:
+                        raise
+
+        if status != "ok":
+            raise RuntimeError(f"Embedding worker failed: {result}")
+        return result
+
+    def info(self) -> dict:
+        """{"model_name": ..., "backend": ...} the worker actually embeds with, asked once."""
+        if self._info is None:
+            self._info = self._request("info", None)
+        return self._info
+
+    def get_query_embedding(self, query: str):
+        return self._request("query", query)
+
+    def get_query_embedding_batch(self, queries):
+        return self._request("query_batch", list(queries))
+
+    def get_text_embedding(self, text: str):
+        return self._request("text_batch", [text])[0]
+
+    def get_text_embedding_batch(self, texts):
+        return self._request("text_batch", list(texts))
+
+
+if __name__ == "__main__":
+    from capagent.config import EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND
+
+    parser = argparse.ArgumentParser("CapAgent embedding worker", add_help=True)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6001)
+    parser.add_argument("--model_name", type=str, default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--backend", type=str, default=EMBEDDING_BACKEND)
+    args = parser.parse_args()
+
+    authkey = os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise SystemExit(f"Set {AUTHKEY_ENV} to a shared secret, clients use the same variable.")
+
+    serve_forever(args.host, args.port, args.model_name, authkey.encode(), backend=args.backend)
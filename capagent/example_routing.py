@@ -0,0 +1,128 @@
+import os
+import re
+import json
+import threading
+
+from capagent.config import COT_EXAMPLES_DIR, COT_EXAMPLES_ROUTING_TABLE
+
+
+_NUMBER = r"(\d+|one|two|three|four|five|six|seven|eight|nine|ten|twenty|thirty|fifty|hundred)"
+
+# constraint type -> patterns of instructions carrying it, matched case-insensitively
+CONSTRAINT_PATTERNS = {
+    "length": [
+        rf"\b{_NUMBER}\s*-?\s*(words?|sentences?|characters?|paragraphs?)\b",
+        r"\b(max(imum)?|min(imum)?)\s+length\b",
+        r"\b(single|one)\s+sentence\b",
+    ],
+    "sentiment": [
+        r"\bsentiment\b",
+        r"\b(positive|negative|neutral|humorous|cheerful|sad|optimistic|pessimistic)\s+(tone|mood|way)\b",
+    ],
+    "keywords": [
+        r"\bkey\s?words?\b",
+        r"\b(include|including|contain|containing|mention|mentioning|use|using)\s+(the\s+)?(words?|phrases?|terms?)\b",
+    ],
+    "search": [
+        r"\bsearch\b",
+        r"\b(politic(s|al)|election|campaign|rally|protest|news|celebrit(y|ies)|famous|landmark)\b",
+    ],
+    "spatial": [
+        r"\bspatial\b",
+        r"\b(position|positions|location|located|relative to|left of|right of|in front of|behind)\b",
+    ],
+    "counting": [
+        r"\bhow many\b",
+        r"\b(count|number of)\b",
+    ],
+}
+
+_COMPILED_PATTERNS = {
+    constraint: [re.compile(pattern, re.IGNORECASE) for pattern in patterns]
+    for constraint, patterns in CONSTRAINT_PATTERNS.items()
+}
+
+
+def classify_constraints(text: str) -> list[str]:
+    """Constraint types of a captioning instruction, in the order of `CONSTRAINT_PATTERNS`."""
+    return [
+        constraint for constraint, patterns in _COMPILED_PATTERNS.items()
+        if any(pattern.search(text) for pattern in patterns)
+    ]
+
+
+def build_routing_table(documents_dir: str = COT_EXAMPLES_DIR) -> dict:
+    """
+    Classify the constraint types of every CoT example, from its header (summary and user request).
+    Returns {"examples": {file name: [constraint types]}}.
+    """
+    examples = {}
+    for name in sorted(os.listdir(documents_dir)):
+        path = os.path.join(documents_dir, name)
+        if name.startswith(".") or not os.path.isfile(path):
+            continue
+        with open(path) as f:
+            header = f.read().split("# RESULT", 1)[0]
+        examples[name] = classify_constraints(header)
+    return {"examples": examples}
+
+
+class ExampleRouter:
+    """
+    Routes a captioning query to CoT examples with the same constraint types, without any retrieval model.
+
+    Examples sharing more constraint types with the query come first, and among those the ones with
+    fewer unrelated constraints. Queries without a recognized constraint are not routed.
+    """
+
+    def __init__(self, routing_table: dict, documents_dir: str = COT_EXAMPLES_DIR):
+        self.example_constraints = {name: set(constraints) for name, constraints in routing_table["examples"].items()}
+        self.texts = {}
+        for name in self.example_constraints:
+            with open(os.path.join(documents_dir, name)) as f:
+                self.texts[name] = f.read()
+
+    def route(self, query_str: str, top_k: int = 2):
+        """Texts of up to `top_k` examples for the query, or None if no example matches its constraints."""
+        constraints = set(classify_constraints(query_str))
+        ranked = sorted(
+            (
+                (-len(constraints & example_constraints), len(example_constraints - constraints), name)
+                for name, example_constraints in self.example_constraints.items()
+                if constraints & example_constraints
+            )
+        )
+        if not ranked:
+            return None
+        return [self.texts[name] for _, _, name in ranked[:top_k]]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_example_router():
+    """Return the process-wide router of the CoT examples, or None if the routing table was not built."""
+    global _router
+    with _router_lock:
+        if _router is None and os.path.exists(COT_EXAMPLES_ROUTING_TABLE):
+            with open(COT_EXAMPLES_ROUTING_TABLE) as f:
+                _router = ExampleRouter(json.load(f))
+    return _router
+
+
+def route_cot_examples(query_str: str, top_k: int = 2):
+    """Joined CoT examples routed by constraint type, or None when the query has to go through retrieval."""
+    router = get_example_router()
+    if router is None:
+        return None
+    texts = router.route(query_str, top_k)
+    return "\n".join(texts) if texts else None
+
+
+if __name__ == "__main__":
+    routing_table = build_routing_table()
+    with open(COT_EXAMPLES_ROUTING_TABLE, "w") as f:
+        json.dump(routing_table, f, indent=2)
+    for name, constraints in routing_table["examples"].items():
+        print(f"{name}: {', '.join(constraints) or '-'}")
@@ -1,4 +1,6 @@
-import os, sys, ast, re, subprocess, tempfile
+import os, sys, ast, re, subprocess, tempfile, queue, shutil
+import concurrent.futures
+from contextlib import contextmanager
 import requests
 from io import BytesIO
 from PIL import Image
@@ -7,6 +9,8 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), "autogen"))
 from autogen.coding import CodeBlock
 from autogen.coding.jupyter import DockerJupyterServer, JupyterCodeExecutor
 from capagent.config import IMAGE_SERVER_DOMAIN_NAME
+from capagent.kernel import KernelProcess
+from capagent.utils import SCRATCH_DIR_ENV
 
 '''parent_dir = os.path.dirname(os.path.abspath(__file__))
 if parent_dir not in sys.path:
@@ -27,7 +31,11 @@ class LocalCommandLineCodeExecutor:
     def __init__(self, work_dir=None):
         #self.work_dir = work_dir or tempfile.mkdtemp()
         self.work_dir = work_dir or project_root
+        # extra environment variables of every interpreter, e.g. the session scratch directory
+        self.env = {}
 
+    def set_env(self, name, value):
+        self.env[name] = value
 
     def execute(self, code, language="python"):
         if language != "python":
@@ -49,6 +57,7 @@ class LocalCommandLineCodeExecutor:
                 capture_output=True,
                 text=True,
                 cwd=repo_root,
+                env=dict(os.environ, **self.env),
                 timeout=60
             )
             return {
@@ -68,14 +77,96 @@ class LocalCommandLineCodeExecutor:
             }
 
 
+# ---------------------------
+# ✅ Persistent Local Kernel Executor
+# ---------------------------
+class LocalKernelCodeExecutor:
+    """
+    Runs every code block in one long-lived python process, so variables, imports and
+    expert clients survive between ACTIONs instead of being rebuilt by a fresh interpreter.
+    """
+
+    def __init__(self, work_dir=None, timeout=60):
+        self.work_dir = work_dir or project_root
+        self.timeout = timeout
+        self.init_code = None
+        self.env = {}
+        self.kernel = KernelProcess(cwd=repo_root)
+
+    def initialize(self, code):
+        # remembered so that a kernel restarted after a timeout gets the same environment again
+        self.init_code = code
+        result = self.kernel.request("execute", code)
+        self.kernel.request("snapshot")
+        return result
+
+    def set_env(self, name, value):
+        # remembered as well, a restarted kernel starts from the environment of this process
+        self.env[name] = value
+        self.kernel.request("execute", self._env_code({name: value}))
+
+    @staticmethod
+    def _env_code(env):
+        return "import os\n" + "".join(f"os.environ[{name!r}] = {value!r}\n" for name, value in env.items())
+
+    def execute(self, code, language="python"):
+        if language != "python":
+            return {
+                "exit_code": 1,
+                "stdout": "",
+                "stderr": f"Unsupported language: {language}",
+                "output_files": [],
+                "output": ""
+            }
+
+        try:
+            return self.kernel.request("execute", code, timeout=self.timeout)
+        except TimeoutError:
+            self.restart()
+            message = "Execution timed out. The kernel was restarted and the variables defined before were lost."
+        except (EOFError, OSError):
+            self.restart()
+            message = "The kernel died during execution. It was restarted and the variables defined before were lost."
+
+        return {
+            "exit_code": -1,
+            "stdout": "",
+            "stderr": message,
+            "output_files": [],
+            "output": message
+        }
+
+    def restart(self):
+        self.kernel.restart()
+        if self.init_code is not None:
+            self.kernel.request("execute", self.init_code)
+            self.kernel.request("snapshot")
+        if self.env:
+            self.kernel.request("execute", self._env_code(self.env))
+
+    def reset(self):
+        """Drop the variables of the previous session and go back to the state right after `initialize`."""
+        if not self.kernel.is_alive():
+            self.restart()
+            return
+        try:
+            self.kernel.request("reset", timeout=self.timeout)
+        except (TimeoutError, EOFError, OSError):
+            self.restart()
+
+    def shutdown(self):
+        self.kernel.shutdown()
+
+
 # ---------------------------
 # ✅ CodeExecutor wrapper
 # ---------------------------
 class CodeExecutor:
-    def __init__(self, working_dir: str = "", use_tools: bool = False, use_docker: bool = False):
+    def __init__(self, working_dir: str = "", use_tools: bool = False, use_docker: bool = False, use_kernel: bool = True):
         self.working_dir = working_dir or "."
         os.makedirs(self.working_dir, exist_ok=True)
         self.use_docker = use_docker
+        self.use_tools = use_tools
 
         if use_docker:
             # 🚀 Docker-based Jupyter executor
@@ -83,8 +174,13 @@ class CodeExecutor:
             print(f"Docker Jupyter server created: {self.server}")
             self.executor = JupyterCodeExecutor(self.server, output_dir=self.working_dir)
             print("Jupyter executor ready")
+        elif use_kernel:
+            # 🖥️ Local executor with a persistent kernel
+            self.server = None
+            self.executor = LocalKernelCodeExecutor(work_dir=self.working_dir)
+            print("Local kernel executor ready")
         else:
-            # 🖥️ Local executor
+            # 🖥️ Local executor, one interpreter per code block
             self.server = None
             self.executor = LocalCommandLineCodeExecutor(work_dir=self.working_dir)
             print("Local executor ready")
@@ -93,6 +189,37 @@ class CodeExecutor:
         self.init_env(use_tools)
         print("Environment initialized")
 
+        self.scratch_dir = None
+        self.images_dir = None
+        self.start_session(self.working_dir)
+
+    def start_session(self, working_dir: str = None):
+        """
+        Create a private scratch directory for the next session and point the tools to it.
+
+        The session's images and the temporary files written by the tools live in this directory,
+        so concurrent sessions never overwrite each other's files.
+        """
+        scratch_root = os.path.join(os.path.abspath(working_dir or self.working_dir), ".tmp")
+        os.makedirs(scratch_root, exist_ok=True)
+        self.scratch_dir = tempfile.mkdtemp(prefix="session_", dir=scratch_root)
+        self.images_dir = os.path.join(self.scratch_dir, "images")
+        os.makedirs(self.images_dir, exist_ok=True)
+
+        if self.use_docker:
+            self.execute(f"import os\nos.environ['{SCRATCH_DIR_ENV}'] = r'{self.scratch_dir}'\n")
+        else:
+            # kept by the local executor, so it survives kernel restarts and one-shot interpreters
+            self.executor.set_env(SCRATCH_DIR_ENV, self.scratch_dir)
+        return self.scratch_dir
+
+    def end_session(self):
+        """Remove the scratch directory of the current session."""
+        if self.scratch_dir is not None:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+        self.scratch_dir = None
+        self.images_dir = None
+
     '''def loading_images(self, image_paths):
         code = ""
         os.makedirs(".tmp", exist_ok=True)
@@ -144,12 +271,9 @@ class CodeExecutor:
 
     def loading_images(self, image_paths):
         code = ""
-        os.makedirs(".tmp", exist_ok=True)
 
-        # ✅ Ensure we have a safe outputs/images directory
-        project_root = os.path.dirname(os.path.abspath(__file__))
-        output_dir = os.path.join(project_root, "outputs", "images")
-        os.makedirs(output_dir, exist_ok=True)
+        # ✅ Images go to the scratch directory of this session
+        output_dir = self.images_dir
 
         print("[DEBUG] Starting image loading...")
         print(f"[DEBUG] Received {len(image_paths)} image paths.")
@@ -177,7 +301,7 @@ class CodeExecutor:
                     print(f"[ERROR] Failed to open local image {path}: {e}")
                     continue
 
-            # ✅ Save locally inside outputs/images
+            # ✅ Save locally inside the session images directory
             image.save(local_file)
             print(f"[DEBUG] Saved image as {local_file}")
 
@@ -246,27 +370,123 @@ class CodeExecutor:
             "import sys\n"
             "from PIL import Image\n"
             "from IPython.display import display\n"
-            f"parent_dir = '{project_root}'\n"
-            "if project_root not in sys.path:\n"
-            "    sys.path.insert(0, project_root)\n"
+            f"repo_root = r'{repo_root}'\n"
+            "if repo_root not in sys.path:\n"
+            "    sys.path.insert(0, repo_root)\n"
             #"from capagent.utils import ImageData\n"
         )
         print("Parent_dir",parent_dir)
         if use_tools:
             init_code += "from capagent.tools import *\n"
 
-        init_resp = self.execute(init_code)
+        if isinstance(self.executor, LocalKernelCodeExecutor):
+            init_resp = self.result_processor(self.executor.initialize(init_code))
+        else:
+            init_resp = self.execute(init_code)
         print(init_resp[1])
 
+    def reset(self):
+        """Reset the execution state so the executor can be handed to a new session."""
+        if isinstance(self.executor, LocalKernelCodeExecutor):
+            self.executor.reset()
+        elif self.use_docker:
+            self.init_env(self.use_tools)
+
     def cleanup(self):
+        self.end_session()
         if self.use_docker and hasattr(self.server, "stop"):
             self.server.stop()
             print("Docker Jupyter server stopped")
+        elif isinstance(self.executor, LocalKernelCodeExecutor):
+            self.executor.shutdown()
+            print("Local kernel stopped")
         else:
             print("Cleanup skipped (local executor)")
 
 
 
+# ---------------------------
+# ✅ Warm executor pool
+# ---------------------------
+class ExecutorPool:
+    """
+    A bounded pool of pre-warmed CodeExecutors shared by concurrent agent sessions.
+
+    Every executor is created up front with the tools already imported, so a session only
+    pays for checking one out. Executors are reset before they go back to the pool, and the
+    pool size bounds the number of kernel processes on the host.
+    """
+
+    def __init__(self, size: int = 4, working_dir: str = ".", use_tools: bool = True, use_docker: bool = False):
+        self.size = size
+        self.working_dir = working_dir
+        self.use_tools = use_tools
+        self.use_docker = use_docker
+        self._idle = queue.Queue()
+        self._closed = False
+
+        # warm up all executors in parallel, importing the tools dominates the startup time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=size) as pool:
+            for executor in pool.map(lambda _: self._create_executor(), range(size)):
+                self._idle.put(executor)
+
+    def _create_executor(self):
+        executor = CodeExecutor(working_dir=self.working_dir, use_tools=self.use_tools, use_docker=self.use_docker)
+        # idle executors keep no scratch directory, every checkout gets a fresh one
+        executor.end_session()
+        return executor
+
+    def acquire(self, timeout: float = None, working_dir: str = None) -> CodeExecutor:
+        """
+        Check out an idle executor, waiting up to `timeout` seconds if all of them are busy.
+        The executor gets a fresh scratch directory under `working_dir`.
+        """
+        if self._closed:
+            raise RuntimeError("The executor pool is closed.")
+        try:
+            executor = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No idle executor within {timeout} seconds.")
+
+        try:
+            executor.start_session(working_dir)
+        except Exception:
+            self._idle.put(executor)
+            raise
+        return executor
+
+    def release(self, executor: CodeExecutor):
+        """Remove the session files, reset the executor and return it to the pool."""
+        if self._closed:
+            executor.cleanup()
+            return
+        try:
+            executor.end_session()
+            executor.reset()
+        except Exception as e:
+            print(f"[WARN] Failed to reset executor, replacing it: {e}")
+            executor.cleanup()
+            executor = self._create_executor()
+        self._idle.put(executor)
+
+    @contextmanager
+    def session(self, timeout: float = None, working_dir: str = None):
+        executor = self.acquire(timeout, working_dir)
+        try:
+            yield executor
+        finally:
+            self.release(executor)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().cleanup()
+            except queue.Empty:
+                break
+
+
+
 '''class LocalCommandLineCodeExecutor:
     def __init__(self, work_dir=None):
         self.work_dir = work_dir or tempfile.mkdtemp()
@@ -0,0 +1,247 @@
+import json
+import time
+import hashlib
+import threading
+from typing import NamedTuple
+
+import httpx
+from PIL import Image
+from gradio_client import Client
+
+from capagent.cache import TieredCache, make_cache_key
+from capagent.config import DETECTION_CACHE_PATH, DETECTION_CACHE_TTL, DETECTION_CACHE_MAX_ITEMS
+
+
+class ExpertClient:
+    """
+    Lazily connected, process-cached handle to the gradio server of an expert model.
+
+    Creating the handle costs nothing: the `gradio_client.Client` handshake happens on the first
+    `predict`, so only the tools that are actually used pay for it. From then on a daemon thread
+    probes the server every `probe_interval` seconds. While the server is down, calls fail right away
+    instead of waiting for a connection timeout; once it is back, the client reconnects.
+    """
+
+    def __init__(self, name: str, host: str, probe_interval: float = 30, probe_timeout: float = 2):
+        self.name = name
+        self.host = host
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.healthy = None  # unknown until the first connection attempt or probe
+        self._client = None
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    def probe(self) -> bool:
+        """Check that the server answers HTTP requests at all."""
+        try:
+            httpx.get(self.host, timeout=self.probe_timeout)
+            return True
+        except httpx.HTTPError:
+            return False
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            healthy = self.probe()
+            with self._lock:
+                if healthy and self.healthy is False:
+                    print(f"✅ {self.name} server at {self.host} is back.")
+                    # the old connection is stale, reconnect on the next call
+                    self._reset()
+                elif not healthy and self.healthy is not False:
+                    print(f"⚠️ {self.name} server at {self.host} is not responding.")
+                self.healthy = healthy
+
+    def _start_probing(self):
+        if self._probe_thread is None:
+            self._probe_thread = threading.Thread(target=self._probe_loop, name=f"probe-{self.name}", daemon=True)
+            self._probe_thread.start()
+
+    def _reset(self):
+        """Forget what is known about the server, it may have been restarted. Called with the lock held."""
+        self._client = None
+
+    def _unavailable(self):
+        return RuntimeError(f"{self.name} server at {self.host} is not available. Tools related to {self.name.lower()} will not work.")
+
+    def get(self):
+        """Return the connected `gradio_client.Client`, connecting on first use."""
+        with self._lock:
+            self._start_probing()
+            if self._client is not None:
+                return self._client
+            if self.healthy is False:
+                raise self._unavailable()
+
+            try:
+                self._client = Client(self.host)
+            except Exception as e:
+                self.healthy = False
+                raise self._unavailable() from e
+            self.healthy = True
+            print(f"{self.name} client is connected to {self.host}.")
+            return self._client
+
+    def predict(self, *args, **kwargs):
+        return self.get().predict(*args, **kwargs)
+
+
+# the detection server resizes the short side of an image to 800 px and caps the long side at 1333 px
+# (T.RandomResize([800], max_size=1333)), and answers with relative boxes, so it never uses more than
+# 1333 px on the long side and larger images are downscaled to that before they are sent
+MAX_IMAGE_SIDE = 1333
+
+
+class EncodedImage(NamedTuple):
+    """Raw RGB bytes of an image, as sent to the expert servers, and their content hash."""
+    data: bytes
+    width: int
+    height: int
+    digest: str
+
+
+def encode_image(image) -> EncodedImage:
+    """
+    Encode a PIL image once, to send it to several expert calls without any PNG encoding or temporary file.
+    Images larger than `MAX_IMAGE_SIDE` are downscaled, keeping their aspect ratio.
+    """
+    if isinstance(image, EncodedImage):
+        return image
+    # convert() returns a copy, the caller's image is left untouched
+    image = image.convert("RGB")
+    if max(image.size) > MAX_IMAGE_SIDE:
+        image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.BILINEAR)
+    data = image.tobytes()
+    digest = hashlib.blake2b(data, digest_size=16, key=f"{image.width}x{image.height}".encode()).hexdigest()
+    return EncodedImage(data, image.width, image.height, digest)
+
+
+_detection_cache = None
+_detection_cache_lock = threading.Lock()
+
+
+def get_detection_cache():
+    """Return the process-wide cache of detection results."""
+    global _detection_cache
+    with _detection_cache_lock:
+        if _detection_cache is None:
+            _detection_cache = TieredCache(
+                path=DETECTION_CACHE_PATH,
+                max_memory_items=1024,
+                max_disk_items=DETECTION_CACHE_MAX_ITEMS,
+                ttl=DETECTION_CACHE_TTL
+            )
+    return _detection_cache
+
+
+class DetectionClient(ExpertClient):
+    """
+    Handle to the GroundingDINO server (`expert_models/client/detection.py`). `detect` posts the raw image
+    bytes to its /detect endpoint, the gradio API stays available through `predict`.
+    Results are cached by detector version, image content, caption and thresholds; pass `cache=False`
+    to disable it. Servers that do not report their version are not cached.
+    """
+
+    def __init__(self, name: str, host: str, timeout: float = 120, cache=None, **kwargs):
+        super().__init__(name, host, **kwargs)
+        self.timeout = timeout
+        self.cache = get_detection_cache() if cache is None else (cache or None)
+        self._http = httpx.Client(timeout=timeout)
+        self._model_version = None
+
+    def _reset(self):
+        super()._reset()
+        self._model_version = None
+
+    def model_version(self):
+        """Version of the detector reported by the server's /version endpoint, asked once; None if unknown."""
+        with self._lock:
+            if self._model_version is not None or self.healthy is False:
+                return self._model_version
+        try:
+            response = self._http.get(f"{self.host.rstrip('/')}/version", timeout=self.probe_timeout)
+            response.raise_for_status()
+            version = response.json()["model"]
+        except (httpx.HTTPError, ValueError, KeyError):
+            return None
+        with self._lock:
+            self._model_version = version
+        return version
+
+    def detect(self, image, caption: str, box_threshold: float = 0.3, text_threshold: float = 0.3) -> dict:
+        """
+        Detect `caption` in a PIL image or `EncodedImage`. Returns the detection JSON with
+        "bboxes" (relative cxcywh), "logits" and "phrases".
+        """
+        # GroundingDINO lowercases and strips the caption itself
+        caption = caption.lower().strip()
+        return self._post("/detect", image, {"caption": caption}, box_threshold, text_threshold)
+
+    def detect_phrases(self, image, phrases: list[str], box_threshold: float = 0.3, text_threshold: float = 0.3) -> dict:
+        """
+        Detect several phrases with a single forward pass of the detector.
+        Returns {phrase: detection JSON like `detect`} for every phrase. The server attributes boxes to
+        phrases by their words, a phrase that gets none is detected again on its own with `detect`.
+        """
+        normalized = {phrase: phrase.lower().strip() for phrase in phrases}
+        image = encode_image(image)
+        result = self._post("/detect_phrases", image, {"phrases": list(dict.fromkeys(normalized.values()))}, box_threshold, text_threshold)
+        for caption, detection in result.items():
+            if not detection["bboxes"]:
+                result[caption] = self.detect(image, caption, box_threshold, text_threshold)
+        return {phrase: result[normalized[phrase]] for phrase in phrases}
+
+    def _post(self, endpoint, image, params, box_threshold, text_threshold):
+        image = encode_image(image)
+        # results of another checkpoint must not be served, so unversioned results are not cached
+        version = self.model_version() if self.cache is not None else None
+        if version is not None:
+            key = make_cache_key(endpoint, self.host, version, image.digest, params, box_threshold, text_threshold)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return json.loads(cached)
+
+        with self._lock:
+            self._start_probing()
+            if self.healthy is False:
+                raise self._unavailable()
+
+        try:
+            response = self._http.post(
+                f"{self.host.rstrip('/')}{endpoint}",
+                content=image.data,
+                params={
+                    **params,
+                    "width": image.width,
+                    "height": image.height,
+                    "box_threshold": box_threshold,
+                    "text_threshold": text_threshold,
+                },
+                headers={"Content-Type": "application/octet-stream"},
+            )
+        except httpx.TransportError as e:
+            with self._lock:
+                self.healthy = False
+                self._reset()
+            raise self._unavailable() from e
+
+        response.raise_for_status()
+        with self._lock:
+            self.healthy = True
+        result = response.json()
+        if version is not None:
+            self.cache.set(key, json.dumps(result).encode("utf-8"))
+        return result
+
+
+_expert_clients = {}
+_expert_clients_lock = threading.Lock()
+
+
+def get_expert_client(name: str, host: str, client_class=ExpertClient) -> ExpertClient:
+    """Return the process-wide handle to the expert server at `host`."""
+    with _expert_clients_lock:
+        if host not in _expert_clients:
+            _expert_clients[host] = client_class(name, host)
+        return _expert_clients[host]
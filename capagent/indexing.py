@@ -1,31 +1,187 @@
+import os
+import re
+import json
+import math
+import threading
 import chromadb
+import numpy as np
+from collections import Counter
 
 from llama_index.core.vector_stores import VectorStoreQuery
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
+from capagent.cache import TieredCache, make_cache_key
+from capagent.example_routing import route_cot_examples
+from capagent.config import COT_EXAMPLES_RETRIEVAL, COT_EXAMPLES_ROUTING, EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_WORKER_ADDRESS, EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ITEMS
 
 
-#embed_model = HuggingFaceEmbedding(model_name="/mnt/sdc/huggingface/model_hub/bge-m3")
-embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-small-en-v1.5")
+# chroma clients, collections, indexes and the embedding model are opened once per process and shared
+_chroma_client = None
+_vector_stores = {}
+_example_indexes = {}
+_hybrid_indexes = {}
+_embed_model = None
+_embedding_cache = None
+_lock = threading.Lock()
 
 
-def load_vector_store(collection_name):
-    
-    db = chromadb.PersistentClient(path="./chroma_db")
+def get_embed_model():
+    """
+    Return the process-wide embedding model, loaded on first use.
+
+    With `EMBEDDING_WORKER_ADDRESS` set, this is a handle to the resident embedding worker
+    and the model is never loaded in this process.
+    """
+    global _embed_model
+    with _lock:
+        if _embed_model is None:
+            if EMBEDDING_WORKER_ADDRESS:
+                from capagent.embedding_worker import RemoteEmbedding, AUTHKEY_ENV
+                _embed_model = RemoteEmbedding(EMBEDDING_WORKER_ADDRESS, os.environ.get(AUTHKEY_ENV, ""), EMBEDDING_MODEL_NAME)
+            else:
+                # importing the embedding integrations pulls in torch or onnxruntime, so it is deferred as well
+                from capagent.embedding_backends import load_embed_model
+                _embed_model = load_embed_model(EMBEDDING_BACKEND, EMBEDDING_MODEL_NAME)
+    return _embed_model
+
+
+def get_embedding_cache():
+    """Return the process-wide cache of query embeddings."""
+    global _embedding_cache
+    with _lock:
+        if _embedding_cache is None:
+            _embedding_cache = TieredCache(
+                path=EMBEDDING_CACHE_PATH,
+                max_memory_items=4096,
+                max_disk_items=EMBEDDING_CACHE_MAX_ITEMS
+            )
+    return _embedding_cache
+
+
+def _embedding_identity():
+    """Model name and backend of the vectors `get_embed_model` produces, from the worker when there is one."""
+    if EMBEDDING_WORKER_ADDRESS:
+        info = get_embed_model().info()
+        return info["model_name"], info["backend"]
+    return EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND
+
+
+def _embedding_cache_key(query_str, identity):
+    # quantized backends give slightly different embeddings, so they get their own entries
+    return make_cache_key(*identity, " ".join(query_str.split()))
+
+
+def query_instruction(embed_model):
+    """The instruction a llama_index huggingface embedding model prepends to retrieval queries, "" if none."""
+    instruction = getattr(embed_model, "query_instruction", None)
+    if instruction is None:
+        try:
+            from llama_index.embeddings.huggingface.utils import get_query_instruct_for_model_name
+        except ImportError:
+            return ""
+        instruction = get_query_instruct_for_model_name(getattr(embed_model, "model_name", ""))
+    return instruction or ""
+
+
+# id of an embedding model -> whether its batched query embeddings match `get_query_embedding`
+_batch_query_checked = {}
+
+
+def embed_query_batch(embed_model, queries):
+    """
+    Embed several retrieval queries with one forward pass.
+
+    The embedding worker has its own batched query call. A local llama_index model gets the queries with
+    its query instruction prepended through the public `get_text_embedding_batch`. The first batch of
+    every model is checked against `get_query_embedding`; if they disagree, e.g. because the model uses
+    another query prompt, its queries are embedded one at a time instead.
+    """
+    queries = list(queries)
+    if hasattr(embed_model, "get_query_embedding_batch"):
+        return embed_model.get_query_embedding_batch(queries)
+
+    key = id(embed_model)
+    if _batch_query_checked.get(key) is False:
+        return [embed_model.get_query_embedding(query) for query in queries]
+
+    instruction = query_instruction(embed_model)
+    embeddings = embed_model.get_text_embedding_batch([instruction + query for query in queries])
+    if key not in _batch_query_checked:
+        reference = np.asarray(embed_model.get_query_embedding(queries[0]), dtype=np.float32)
+        first = np.asarray(embeddings[0], dtype=np.float32)
+        cosine = float(reference @ first / max(float(np.linalg.norm(reference) * np.linalg.norm(first)), 1e-12))
+        _batch_query_checked[key] = cosine > 0.999
+        if not _batch_query_checked[key]:
+            print(f"⚠️ Batched query embeddings of {type(embed_model).__name__} differ from get_query_embedding, embedding queries one at a time.")
+            return [embed_model.get_query_embedding(query) for query in queries]
+    return embeddings
+
+
+def get_query_embedding(query_str):
+    """
+    Embed a retrieval query, as a float32 array.
 
-    # get collection
-    chroma_collection = db.get_or_create_collection(collection_name)
+    Embeddings are cached by model name, backend and query text with collapsed whitespace,
+    so repeated instruction templates skip the forward pass. With an embedding worker, the model
+    name and backend are the ones the worker reports.
+    """
+    return get_query_embeddings([query_str])[0]
 
-    # assign chroma as the vector_store to the context
-    vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
 
-    return vector_store
+def get_query_embeddings(query_strs):
+    """
+    Embed many retrieval queries, as a float32 matrix with one row per query.
+
+    Cached queries are looked up individually, the remaining ones are embedded in one batch.
+    """
+    cache = get_embedding_cache()
+    identity = _embedding_identity()
+    keys = [_embedding_cache_key(query_str, identity) for query_str in query_strs]
+    embeddings = [None] * len(keys)
+
+    missing = {}  # cache key -> indices of the queries with that key
+    for i, key in enumerate(keys):
+        cached = cache.get(key)
+        if cached is not None:
+            embeddings[i] = np.frombuffer(cached, dtype=np.float32)
+        else:
+            missing.setdefault(key, []).append(i)
+
+    if missing:
+        queries = [query_strs[indices[0]] for indices in missing.values()]
+        if len(queries) == 1:
+            computed = [get_embed_model().get_query_embedding(queries[0])]
+        else:
+            computed = embed_query_batch(get_embed_model(), queries)
+        for (key, indices), embedding in zip(missing.items(), computed):
+            embedding = np.asarray(embedding, dtype=np.float32)
+            cache.set(key, embedding.tobytes())
+            for i in indices:
+                embeddings[i] = embedding
+
+    return np.stack(embeddings) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+
+def _get_collection(collection_name):
+    global _chroma_client
+    if _chroma_client is None:
+        _chroma_client = chromadb.PersistentClient(path="./chroma_db")
+    return _chroma_client.get_or_create_collection(collection_name)
+
+
+def load_vector_store(collection_name):
+
+    with _lock:
+        if collection_name not in _vector_stores:
+            # assign chroma as the vector_store to the context
+            _vector_stores[collection_name] = ChromaVectorStore(chroma_collection=_get_collection(collection_name))
+
+    return _vector_stores[collection_name]
 
 
 def query_vector_store(vector_store, query_str, query_mode, similarity_top_k=1):
 
-    query_embedding = embed_model.get_query_embedding(query_str)
+    query_embedding = get_query_embedding(query_str).tolist()
 
     vector_store_query = VectorStoreQuery(
         query_embedding=query_embedding, similarity_top_k=similarity_top_k, mode=query_mode
@@ -35,6 +191,215 @@ def query_vector_store(vector_store, query_str, query_mode, similarity_top_k=1):
 
     return query_result
 
+
+def _top_k(scores, top_k):
+    """Indices of the `top_k` highest scores of every row, highest first."""
+    top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    return np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+
+class InMemoryExampleIndex:
+    """
+    Exact top-k retrieval over a small collection held in memory.
+
+    The embeddings are stored as one L2-normalized float32 matrix, so a query is a single
+    matrix-vector product followed by a partial sort, with no database round trip.
+    """
+
+    def __init__(self, texts: list[str], embeddings):
+        self.texts = list(texts)
+        if not self.texts:
+            # an empty or not yet built collection, queries return no examples
+            self.embeddings = np.zeros((0, 0), dtype=np.float32)
+            return
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(self.texts), -1)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def from_collection(cls, collection_name):
+        data = _get_collection(collection_name).get(include=["embeddings", "documents"])
+        if not data["documents"]:
+            print(f"⚠️ Collection {collection_name} is empty, build it with `python embedding.py`.")
+        return cls(data["documents"] or [], data["embeddings"])
+
+    def scores(self, query_embeddings):
+        """Cosine similarity of every query embedding (one per row) to every example."""
+        query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+        norms = np.linalg.norm(query_embeddings, axis=1, keepdims=True)
+        return (query_embeddings / np.maximum(norms, 1e-12)) @ self.embeddings.T
+
+    def query(self, query_embedding, top_k=1):
+        """Return the texts of the `top_k` most similar examples, most similar first."""
+        return self.query_batch(np.asarray(query_embedding, dtype=np.float32)[None], top_k)[0]
+
+    def query_batch(self, query_embeddings, top_k=1):
+        """`query` for a matrix of query embeddings (one per row), scored with a single matrix product."""
+        if not self.texts:
+            return [[] for _ in range(len(query_embeddings))]
+        top = _top_k(self.scores(query_embeddings), min(top_k, len(self.texts)))
+        return [[self.texts[i] for i in row] for row in top]
+
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    return _TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Okapi BM25 scores over a small corpus, from an inverted index of term -> (document, term frequency)."""
+
+    def __init__(self, texts: list[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.n_docs = len(texts)
+        self.postings = {}
+        doc_lengths = []
+        for i, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                self.postings.setdefault(term, []).append((i, tf))
+
+        doc_lengths = np.asarray(doc_lengths, dtype=np.float32)
+        average_length = max(float(doc_lengths.mean()), 1.0) if self.n_docs else 1.0
+        self.length_norm = k1 * (1 - b + b * doc_lengths / average_length)
+        # the "+1" variant of the idf, which stays positive for terms found in most documents
+        self.idf = {
+            term: math.log(1 + (self.n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def scores(self, query_str):
+        scores = np.zeros(self.n_docs, dtype=np.float32)
+        for term in set(tokenize(query_str)):
+            for i, tf in self.postings.get(term, ()):
+                scores[i] += self.idf[term] * tf * (self.k1 + 1) / (tf + self.length_norm[i])
+        return scores
+
+
+def _min_max(scores):
+    span = scores.max(axis=-1, keepdims=True) - scores.min(axis=-1, keepdims=True)
+    return (scores - scores.min(axis=-1, keepdims=True)) / np.maximum(span, 1e-12)
+
+
+class HybridExampleIndex:
+    """
+    BM25 over the example headers fused with dense similarity, for the few, very literal CoT examples.
+
+    Only the header of an example (its summary and user request, before "# RESULT") is indexed
+    lexically, since that is where the constraints ("within 10 words", "sentiment") are spelled out.
+    When the lexical top-k is clear, i.e. its k-th score reaches `min_lexical_score` and beats the
+    next one by `lexical_margin` times, it is returned without embedding the query. Otherwise both
+    scores are min-max normalized and fused with `dense_weight`. Results are cached per query.
+    """
+
+    def __init__(self, dense_index: InMemoryExampleIndex, dense_weight: float = 0.5, min_lexical_score: float = 2.0, lexical_margin: float = 1.5, cache_size: int = 1024):
+        self.dense_index = dense_index
+        self.texts = dense_index.texts
+        self.bm25 = BM25Index([text.split("# RESULT", 1)[0] for text in self.texts])
+        self.dense_weight = dense_weight
+        self.min_lexical_score = min_lexical_score
+        self.lexical_margin = lexical_margin
+        self._cache = TieredCache(max_memory_items=cache_size)
+
+    def _lexical_top_k(self, lexical, top_k):
+        """The lexical top-k if it is confident, else None."""
+        order = np.argsort(-lexical)
+        kth_score = lexical[order[top_k - 1]]
+        next_score = lexical[order[top_k]] if top_k < len(order) else 0.0
+        if kth_score >= self.min_lexical_score and kth_score >= self.lexical_margin * next_score:
+            return order[:top_k].tolist()
+        return None
+
+    def query(self, query_str, top_k=1):
+        return self.query_batch([query_str], top_k)[0]
+
+    def query_batch(self, query_strs, top_k=1):
+        """Texts of the `top_k` best examples of every query; the queries that need it are embedded in one batch."""
+        if not self.texts:
+            return [[] for _ in query_strs]
+        top_k = min(top_k, len(self.texts))
+
+        results = [None] * len(query_strs)
+        to_embed = []  # (position, cache key, lexical scores)
+        for i, query_str in enumerate(query_strs):
+            key = make_cache_key(" ".join(query_str.split()), top_k)
+            cached = self._cache.get(key)
+            if cached is not None:
+                results[i] = json.loads(cached)
+                continue
+
+            lexical = self.bm25.scores(query_str)
+            results[i] = self._lexical_top_k(lexical, top_k)
+            if results[i] is None:
+                to_embed.append((i, key, lexical))
+            else:
+                self._cache.set(key, json.dumps(results[i]).encode("utf-8"))
+
+        if to_embed:
+            dense = self.dense_index.scores(get_query_embeddings([query_strs[i] for i, _, _ in to_embed]))
+            lexical = np.stack([scores for _, _, scores in to_embed])
+            fused = self.dense_weight * _min_max(dense) + (1 - self.dense_weight) * _min_max(lexical)
+            for (i, key, _), row in zip(to_embed, _top_k(fused, top_k)):
+                results[i] = row.tolist()
+                self._cache.set(key, json.dumps(results[i]).encode("utf-8"))
+
+        return [[self.texts[j] for j in indices] for indices in results]
+
+
+def load_example_index(collection_name):
+    """Return the process-wide in-memory index of a collection, built from the chroma collection on first use."""
+    with _lock:
+        if collection_name not in _example_indexes:
+            _example_indexes[collection_name] = InMemoryExampleIndex.from_collection(collection_name)
+    return _example_indexes[collection_name]
+
+
+def load_hybrid_index(collection_name):
+    """Return the process-wide hybrid BM25 + dense index of a collection."""
+    example_index = load_example_index(collection_name)
+    with _lock:
+        if collection_name not in _hybrid_indexes:
+            _hybrid_indexes[collection_name] = HybridExampleIndex(example_index)
+    return _hybrid_indexes[collection_name]
+
+
+def query_example_index(example_index, query_str, similarity_top_k=1):
+    return example_index.query(get_query_embedding(query_str), similarity_top_k)
+
+
+def batch_query_example_index(example_index, query_strs, similarity_top_k=1):
+    """Texts of the `similarity_top_k` most similar examples of every query, with one embedding batch and one top-k."""
+    query_strs = list(query_strs)
+    if not query_strs:
+        return []
+    return example_index.query_batch(get_query_embeddings(query_strs), similarity_top_k)
+
+
+def batch_retrieve_cot_examples(query_strs, similarity_top_k=2):
+    """
+    CoT examples for many captioning queries at once, joined the way `CapAgent.get_cot_examples` joins them.
+
+    Pass the results to `CapAgent.initiate_chat(..., cot_examples=...)` to skip retrieval in the chat.
+    """
+    query_strs = list(query_strs)
+    results = [route_cot_examples(query_str, similarity_top_k) if COT_EXAMPLES_ROUTING else None for query_str in query_strs]
+    unrouted = [i for i, result in enumerate(results) if result is None]
+    if not unrouted:
+        return results
+
+    unrouted_queries = [query_strs[i] for i in unrouted]
+    if COT_EXAMPLES_RETRIEVAL == "hybrid":
+        retrieved = load_hybrid_index("cot_examples").query_batch(unrouted_queries, similarity_top_k)
+    else:
+        retrieved = batch_query_example_index(load_example_index("cot_examples"), unrouted_queries, similarity_top_k)
+    for i, texts in zip(unrouted, retrieved):
+        results[i] = "\n".join(texts)
+    return results
+
+
 if __name__ == "__main__":
     vector_store = load_vector_store("cot_examples")
     query_result = query_vector_store(vector_store, "caption this image with positive sentiment.", "default", similarity_top_k=1)
@@ -0,0 +1,160 @@
+import io
+import os
+import sys
+import secrets
+import traceback
+import subprocess
+from contextlib import redirect_stdout, redirect_stderr
+from multiprocessing.connection import Listener, Client
+
+
+AUTHKEY_ENV = "CAPAGENT_KERNEL_AUTHKEY"
+
+
+def _run_code(code, namespace):
+    stdout, stderr = io.StringIO(), io.StringIO()
+    exit_code = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            exec(compile(code, "<action>", "exec"), namespace)
+        except SystemExit as e:
+            exit_code = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            # drop the frame of this function, the traceback should start at the ACTION code
+            traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+            exit_code = 1
+
+    stdout, stderr = stdout.getvalue(), stderr.getvalue()
+    return {
+        "exit_code": exit_code,
+        "stdout": stdout,
+        "stderr": stderr,
+        "output_files": [],
+        "output": stdout + ("\n" + stderr if stderr else "")
+    }
+
+
+def serve(conn):
+    """
+    Serve requests of one executor until it asks for shutdown or disconnects.
+
+    The kernel keeps one global namespace alive for its whole lifetime, so variables
+    and imports of an ACTION are visible to the following ones, like a jupyter kernel.
+    Requests arrive as `(command, payload)` tuples and each one gets exactly one reply.
+    `snapshot` and `reset` let a pooled kernel go back to its warm state between sessions.
+    """
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    snapshot = dict(namespace)
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            break
+
+        if command == "execute":
+            conn.send(_run_code(payload, namespace))
+        elif command == "snapshot":
+            # remember the warm state, e.g. right after the tools have been imported
+            snapshot = dict(namespace)
+            conn.send(None)
+        elif command == "reset":
+            # forget the variables of the last session, imported modules stay cached in sys.modules
+            namespace.clear()
+            namespace.update(snapshot)
+            conn.send(None)
+        elif command == "shutdown":
+            conn.send(None)
+            break
+        else:
+            conn.send({
+                "exit_code": 1,
+                "stdout": "",
+                "stderr": f"Unknown kernel command: {command}",
+                "output_files": [],
+                "output": f"Unknown kernel command: {command}"
+            })
+
+    conn.close()
+
+
+class KernelProcess:
+    """
+    Handle to a long-lived python process that executes code in a persistent namespace.
+    """
+
+    def __init__(self, cwd: str):
+        self.cwd = cwd
+        self._process = None
+        self._conn = None
+        self.start()
+
+    def start(self):
+        authkey = secrets.token_hex(16)
+        env = dict(os.environ, **{AUTHKEY_ENV: authkey})
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [self.cwd, env.get("PYTHONPATH")]))
+
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "capagent.kernel"],
+            cwd=self.cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+
+        # the kernel announces the port it listens on as its first line of output
+        port = self._process.stdout.readline().strip()
+        if not port:
+            self._process.wait()
+            raise RuntimeError(f"Kernel process exited during startup with code {self._process.returncode}.")
+        self._conn = Client(("127.0.0.1", int(port)), authkey=authkey.encode())
+
+    def is_alive(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def request(self, command: str, payload=None, timeout: float = None):
+        """
+        Send a request to the kernel and wait for its reply.
+
+        Raises:
+            TimeoutError: if the kernel does not answer within `timeout` seconds
+            EOFError: if the kernel process died while handling the request
+        """
+        self._conn.send((command, payload))
+        if not self._conn.poll(timeout):
+            raise TimeoutError(f"Kernel did not answer within {timeout} seconds.")
+        return self._conn.recv()
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def kill(self):
+        if self._conn is not None:
+            self._conn.close()
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process.stdout.close()
+        self._process, self._conn = None, None
+
+    def shutdown(self, timeout: float = 5):
+        if self.is_alive():
+            try:
+                self.request("shutdown", timeout=timeout)
+                self._process.wait(timeout)
+            except (TimeoutError, EOFError, OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
+
+if __name__ == "__main__":
+    listener = Listener(("127.0.0.1", 0), authkey=os.environ.pop(AUTHKEY_ENV).encode())
+    print(listener.address[1], flush=True)
+
+    # nobody reads the handshake pipe after this point, send raw fd writes (e.g. from subprocesses) to stderr
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    connection = listener.accept()
+    listener.close()
+    serve(connection)
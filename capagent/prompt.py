@@ -1,5 +1,5 @@
-from capagent.tool_prompt import extract_tool_prompt
-import importlib
+from capagent.tool_prompt import extract_tool_prompt, select_tools
+from capagent.config import PRUNE_TOOL_PROMPT
 import os
 
 ASSISTANT_SYSTEM_MESSAGE = """You are a helpful AI assistant.
@@ -23,32 +23,44 @@ If you think you get the answer to the initial user request, you can reply with
 
 
 
+TOOLS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools.py")
+
+
 class ReActPrompt:
-    
-    def __init__(self) -> None:
-        self.tools = importlib.import_module("capagent.tools")
-        
-    def initial_prompt(self, query: str, n_images: int, tool_usage_example: str) -> str:
 
-        _init_prompt = f"""Here are some tools that can help you. 
+    def __init__(self, prune_tools: bool = PRUNE_TOOL_PROMPT) -> None:
+        # only show the tools relevant to each request, see `select_tools`
+        self.prune_tools = prune_tools
+
+    def static_prefix(self, tools: list[str] = None) -> str:
+        """
+        The part of the initial prompt shared by all requests with the same tools: the tool catalogue.
+
+        It only changes when `capagent/tools.py` changes, so after the fixed system message it forms a
+        byte-stable prefix that providers with prompt caching can reuse across requests. A pruned
+        catalogue is stable as well for every request with the same set of tools.
+        """
+        return f"""Here are some tools that can help you. 
     All are Python functions defined in `capagent/tools.py`. 
     You must import the ones you want to use, for example:
     `from capagent.tools import visual_question_answering_image`.
-        Below are the tools in `capagent/tools.py`:
+        Below are the tools in `capagent/tools.py`{"" if tools is None else " relevant to this request"}:
 ```python
-{extract_tool_prompt("capagent/tools.py")}
+{extract_tool_prompt(TOOLS_FILE, tools)}
 
 ```
 
-Below are some examples of how to use the tools to solve the user requests. You can refer to them for help. You can also refer to the tool descriptions for more information.
+"""
+
+    def dynamic_suffix(self, query: str, n_images: int, tool_usage_example: str, images_dir: str = None) -> str:
+        """The per-request part of the initial prompt: CoT examples, user request and images."""
+        prompt = f"""Below are some examples of how to use the tools to solve the user requests. You can refer to them for help. You can also refer to the tool descriptions for more information.
 {tool_usage_example}
 
 """
-
-        prompt = _init_prompt
         prompt += f"# USER REQUEST #: {query}\n"
         if n_images > 0:
-            images_dir = os.path.join("capagent", "outputs", "images")
+            images_dir = images_dir or os.path.join("capagent", "outputs", "images")
             image_loading_code = "\n".join([
                 f"image_{i} = Image.open(r'{images_dir}/image_{i}.png').convert('RGB')" 
                 for i in range(1, n_images+1)
@@ -62,6 +74,10 @@ Below are some examples of how to use the tools to solve the user requests. You
             prompt += "# USER IMAGE: No image provided.\n"
         prompt += "Now please generate only THOUGHT 0 and ACTION 0 in RESULT. If no action needed, also reply with ANSWER: <your answer> and ends with TERMINATE in the RESULT:\n# RESULT #:\n"
         return prompt
+        
+    def initial_prompt(self, query: str, n_images: int, tool_usage_example: str, images_dir: str = None) -> str:
+        tools = select_tools(TOOLS_FILE, query, tool_usage_example) if self.prune_tools else None
+        return self.static_prefix(tools) + self.dynamic_suffix(query, n_images, tool_usage_example, images_dir=images_dir)
     
     def get_parsing_feedback(self, error_message: str, error_code: str) -> str:
         return f"OBSERVATION: Parsing error. Error code: {error_code}, Error message:\n{error_message}\nPlease fix the error and generate the fixed code, in the next THOUGHT and ACTION."
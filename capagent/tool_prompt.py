@@ -1,6 +1,93 @@
+import os
+import re
 import ast
-
-def extract_tool_prompt(file_path):
+import argparse
+import threading
+
+from capagent.example_routing import classify_constraints
+
+
+# tools every request may need, whatever its constraints
+CORE_TOOLS = ["visual_question_answering_image"]
+
+# constraint type (see `capagent.example_routing`) -> tools that handle it
+CONSTRAINT_TOOLS = {
+    "length": ["count_words", "count_sentences", "shorten_caption", "extend_caption"],
+    "sentiment": ["change_caption_sentiment"],
+    "keywords": ["add_keywords_to_caption", "count_words"],
+    "search": ["ImageData", "google_search", "google_lens_search"],
+    "spatial": ["spatial_relation_of_objects", "crop_object_region"],
+    "counting": ["counting_object", "crop_object_region"],
+}
+
+
+# absolute path -> (mtime_ns, size, [(tool name, rendered entry)])
+_tool_prompt_cache = {}
+_tool_prompt_lock = threading.Lock()
+
+
+def extract_tool_entries(file_path):
+    """
+    (name, signature and docstring) of every tool in `file_path`, in file order, rendered once per process.
+
+    The rendered entries are reused until the file's modification time or size changes,
+    so prompts built from them stay byte-identical between requests.
+    """
+    path = os.path.abspath(file_path)
+    stat = os.stat(path)
+    with _tool_prompt_lock:
+        cached = _tool_prompt_cache.get(path)
+        if cached is not None and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+
+    entries = _render_tool_entries(path)
+    with _tool_prompt_lock:
+        _tool_prompt_cache[path] = (stat.st_mtime_ns, stat.st_size, entries)
+    return entries
+
+
+def extract_tool_prompt(file_path, tools=None):
+    """Signatures and docstrings of the tools in `file_path`, only of the ones named in `tools` if given."""
+    entries = extract_tool_entries(file_path)
+    if tools is not None:
+        tools = set(tools)
+        entries = [(name, entry) for name, entry in entries if name in tools]
+    return "\n".join(entry for _, entry in entries)
+
+
+def select_tools(file_path, query, cot_examples=""):
+    """
+    Names of the tools relevant to a request, or None if the full catalogue should be used.
+
+    The selection is the core tools, the tools handling the constraint types of the query and the tools
+    called in the retrieved CoT examples. Requests without any recognized constraint get every tool.
+    """
+    names = [name for name, _ in extract_tool_entries(file_path)]
+    selected = set()
+    for constraint in classify_constraints(query):
+        selected.update(CONSTRAINT_TOOLS.get(constraint, []))
+    selected.update(name for name in names if re.search(rf"\b{name}\b", cot_examples))
+    if not selected:
+        return None
+    selected.update(CORE_TOOLS)
+    return [name for name in names if name in selected]
+
+
+def tool_prompt_size_report(file_path, tools):
+    """Size of the pruned catalogue against the full one, in characters and estimated tokens (~4 characters each)."""
+    full = len(extract_tool_prompt(file_path))
+    pruned = len(extract_tool_prompt(file_path, tools))
+    return {
+        "tools": len(extract_tool_entries(file_path)) if tools is None else len(tools),
+        "full_chars": full,
+        "pruned_chars": pruned,
+        "full_tokens": full // 4,
+        "pruned_tokens": pruned // 4,
+        "reduction": 1 - pruned / full if full else 0.0,
+    }
+
+
+def _render_tool_entries(file_path):
     docstrings_list = []
 
     # Open and parse the file
@@ -55,7 +142,7 @@ def extract_tool_prompt(file_path):
                     class_entry += f"\"\"\"\n{class_docstring}\n\"\"\"\n"
                 if init_signature and init_docstring:
                     class_entry += f"    {init_signature}:\n    \"\"\"\n{init_docstring}\n\"\"\"\n"
-                docstrings_list.append(class_entry)
+                docstrings_list.append((class_name, class_entry))
 
             elif isinstance(node, ast.FunctionDef):
                 # Handle standalone functions
@@ -90,11 +177,19 @@ def extract_tool_prompt(file_path):
                 docstring = ast.get_docstring(node)
                 if docstring:
                     function_entry = f"{signature}:\n\"\"\"\n{docstring}\n\"\"\"\n"
-                    docstrings_list.append(function_entry)
+                    docstrings_list.append((name, function_entry))
 
-    return "\n".join(docstrings_list)
+    return docstrings_list
 
 # Example usage
 if __name__ == "__main__":
-    result = extract_tool_prompt("capagent/tools.py")
-    print(result)
+    parser = argparse.ArgumentParser("Print the tool prompt", add_help=True)
+    parser.add_argument("--query", type=str, default=None, help="prune the catalogue for this request and report its size")
+    args = parser.parse_args()
+
+    if args.query is None:
+        print(extract_tool_prompt("capagent/tools.py"))
+    else:
+        tools = select_tools("capagent/tools.py", args.query)
+        print(extract_tool_prompt("capagent/tools.py", tools))
+        print(tool_prompt_size_report("capagent/tools.py", tools))
@@ -12,24 +12,15 @@ from capagent.config import (
     IMAGE_SERVER_DOMAIN_NAME
 )
 from capagent.chat_models.client import llm_client, mllm_client
-from capagent.utils import encode_pil_to_base64
-from gradio_client import Client, file
+from capagent.utils import encode_pil_to_base64, scratch_path
+from capagent.expert_clients import get_expert_client, DetectionClient
+from gradio_client import file
 from pprint import pprint
 
 
-try:
-    detection_client = Client(DETECTION_CLIENT_HOST)
-    print("Detection client is listening on port 8080.")
-except Exception as e:
-    print("Detection client is not working properly. Tools related to detection will not work.")
-    detection_client = None
-
-try:
-    depth_client = Client(DEPTH_CLIENT_HOST)
-    print("Depth client is listening on port 8081.")
-except Exception as e:
-    print("Depth client is not working properly. Tools related to depth will not work.")
-    depth_client = None
+# connected on first use, so importing the tools does not wait for the expert servers
+detection_client = get_expert_client("Detection", DETECTION_CLIENT_HOST, DetectionClient)
+depth_client = get_expert_client("Depth", DEPTH_CLIENT_HOST)
 
 
 class ImageData:
@@ -388,8 +379,8 @@ def crop_object_region(image: Image.Image, object: str) -> Image.Image:
         PIL.Image.Image: The cropped image containing the object region.
     """ 
 
-    # Run detection (assuming `detection_client.predict` accepts raw image)
-    _, result_json = detection_client.predict(file(image), object, 0.3, 0.3)  
+    # Run detection
+    result_json = detection_client.detect(image, object, 0.3, 0.3)
     bbox = result_json['bboxes'][0]  # cxcywh (relative)
 
     width, height = image.size
@@ -406,7 +397,7 @@ def crop_object_region(image: Image.Image, object: str) -> Image.Image:
     crop_image = copy.deepcopy(image).crop((bbox[0], bbox[1], bbox[2], bbox[3]))
 
     # Optional: save locally
-    crop_image.save("./.tmp/crop_image.png")
+    crop_image.save(scratch_path("crop_image.png"))
 
     return crop_image
 
@@ -423,13 +414,8 @@ def counting_object(image: Image.Image, object: str = None, show_result: bool =
     Returns:
         int: Number of detected objects
     """
-    # Save temp file for the detection client
-    os.makedirs("./.tmp", exist_ok=True)
-    temp_path = "./.tmp/temp_image.png"
-    image.save(temp_path)
-
     # Run detection
-    _, result_json = detection_client.predict(file(temp_path), object, 0.3, 0.3)
+    result_json = detection_client.detect(image, object, 0.3, 0.3)
 
     count = len(result_json.get("phrases", []))
     if show_result and count > 0:
@@ -458,10 +444,9 @@ def spatial_relation_of_objects(image: Image.Image, objects: list[str], show_res
         str: The spatial relation of the objects
     """
 
-    # Save temp image for processing
-    os.makedirs("./.tmp", exist_ok=True)
-    temp_path = "./.tmp/temp_image.png"
-    image.save(temp_path)
+    # The depth server only takes files, save the image once without spending time on compression
+    temp_path = scratch_path("temp_image.png")
+    image.save(temp_path, compress_level=1)
 
     position_list = []
 
@@ -469,14 +454,16 @@ def spatial_relation_of_objects(image: Image.Image, objects: list[str], show_res
     _, grayscale_depth_map, _ = depth_client.predict(file(temp_path), api_name="/on_submit")
 
     depth_map = Image.open(grayscale_depth_map).convert("L")
-    depth_map.save("./.tmp/depth_map.png")
     depth_map = np.array(depth_map)
     depth_map = depth_map / 255.0  # normalize to 0-1
 
     assert objects is not None, "Objects are not specified."
 
+    # Detect all objects with one forward pass of the detector
+    detections = detection_client.detect_phrases(image, objects, 0.3, 0.3)
+
     for object in objects:
-        _, result_json = detection_client.predict(file(temp_path), object, 0.3, 0.3)
+        result_json = detections[object]
 
         for bbox, phrase in zip(result_json['bboxes'], result_json['phrases']):
             relative_bbox = [
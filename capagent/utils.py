@@ -1,8 +1,13 @@
+import os
 import base64
 import json
 from io import BytesIO
 
 
+# Set by the executor in every kernel, so tools of concurrent sessions never share temporary files
+SCRATCH_DIR_ENV = "CAPAGENT_SCRATCH_DIR"
+
+
 def encode_pil_to_base64(image):
     buffered = BytesIO()
     image.save(buffered, format="JPEG")
@@ -13,4 +18,24 @@ def save_jsonlines(data, file_path):
     with open(file_path, 'w') as f:
         for item in data:
             json.dump(item, f, indent=4)
-            f.write('\n')
\ No newline at end of file
+            f.write('\n')
+
+def iter_jsonlines(file_path):
+    """Stream the records of a JSONL file (one JSON object per line) without loading the whole file."""
+    with open(file_path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def append_jsonline(item, f):
+    """Append one record to an open JSONL file and flush it, so it survives a crash."""
+    f.write(json.dumps(item, ensure_ascii=False) + '\n')
+    f.flush()
+
+
+def scratch_path(filename):
+    """Return a path for a temporary file inside the scratch directory of the current session."""
+    scratch_dir = os.environ.get(SCRATCH_DIR_ENV, ".tmp")
+    os.makedirs(scratch_dir, exist_ok=True)
+    return os.path.join(scratch_dir, filename)
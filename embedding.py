@@ -1,16 +1,58 @@
+import os
+import json
+import hashlib
+import argparse
 import chromadb
 
 from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, StorageContext
 from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
+from capagent.config import EMBEDDING_MODEL_NAME
+from capagent.embedding_backends import EMBEDDING_BACKENDS, load_embed_model
 
-def build_vector_store(documents_dir: str, collection_name: str):
 
-    # load some documents
-    documents = SimpleDirectoryReader(documents_dir).load_data()
+def file_hash(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def list_documents(documents_dir: str) -> dict:
+    """Content hash of every document SimpleDirectoryReader would load from `documents_dir`, by file name."""
+    return {
+        name: file_hash(os.path.join(documents_dir, name))
+        for name in sorted(os.listdir(documents_dir))
+        if not name.startswith(".") and os.path.isfile(os.path.join(documents_dir, name))
+    }
+
+
+def load_manifest(manifest_path: str, embed_model_name: str, backend: str) -> dict:
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("embed_model") == embed_model_name and manifest.get("backend", "torch") == backend:
+            return manifest
+    return {"embed_model": embed_model_name, "backend": backend, "files": {}}
+
+
+def build_vector_store(documents_dir: str, collection_name: str, embed_model_name: str = EMBEDDING_MODEL_NAME, db_path: str = "./chroma_db", rebuild: bool = False, backend: str = "torch"):
+    """
+    Bring the collection up to date with the documents in `documents_dir`.
+
+    The manifest next to the database records the content hash and document ids of every indexed
+    file, so only new or changed files are embedded and the vectors of changed or removed files are
+    deleted. Everything is re-embedded with `rebuild`, or when the embedding model or backend changed.
+    Returns the chroma vector store of the collection.
+    """
     # initialize client, setting path to save data
-    db = chromadb.PersistentClient(path="./chroma_db")
+    db = chromadb.PersistentClient(path=db_path)
+    manifest_path = os.path.join(db_path, f"{collection_name}_manifest.json")
+    manifest = load_manifest(manifest_path, embed_model_name, backend)
+
+    if rebuild or not manifest["files"]:
+        # start from an empty collection, also dropping vectors of another embedding model
+        if collection_name in [getattr(c, "name", c) for c in db.list_collections()]:
+            db.delete_collection(collection_name)
+        manifest["files"] = {}
 
     # create collection
     chroma_collection = db.get_or_create_collection(collection_name)
@@ -19,16 +61,53 @@ def build_vector_store(documents_dir: str, collection_name: str):
     vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
     storage_context = StorageContext.from_defaults(vector_store=vector_store)
 
-    embed_model = HuggingFaceEmbedding(model_name="/mnt/sdc/huggingface/model_hub/bge-m3", max_length=8192)
-    
-    # create your index
-    index = VectorStoreIndex.from_documents(
-        documents, storage_context=storage_context, embed_model=embed_model, show_progress=True
-    )
+    current = list_documents(documents_dir)
+    indexed = manifest["files"]
+    removed = [name for name in indexed if name not in current]
+    changed = [name for name in indexed if name in current and indexed[name]["sha256"] != current[name]]
+    added = [name for name in current if name not in indexed]
+    print(f"{len(added)} new, {len(changed)} changed, {len(removed)} removed, {len(current) - len(added) - len(changed)} unchanged documents.")
+
+    for name in removed + changed:
+        for doc_id in indexed.pop(name)["doc_ids"]:
+            vector_store.delete(ref_doc_id=doc_id)
+
+    to_embed = changed + added
+    if to_embed:
+        documents = SimpleDirectoryReader(input_files=[os.path.join(documents_dir, name) for name in to_embed]).load_data()
+        # stable ids, so the vectors of a file can be deleted when it changes
+        for name in to_embed:
+            file_documents = [doc for doc in documents if os.path.basename(doc.metadata["file_path"]) == name]
+            for i, doc in enumerate(file_documents):
+                doc.id_ = name if len(file_documents) == 1 else f"{name}_part_{i}"
+            indexed[name] = {"sha256": current[name], "doc_ids": [doc.id_ for doc in file_documents]}
+
+        embed_model = load_embed_model(backend, embed_model_name)
 
-    # from IPython import embed; embed()
+        # create your index
+        VectorStoreIndex.from_documents(
+            documents, storage_context=storage_context, embed_model=embed_model, show_progress=True
+        )
+
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    return vector_store
 
-    return index
 
 if __name__ == "__main__":
-    build_vector_store(documents_dir="./data/cot_examples", collection_name="cot_examples")
+    parser = argparse.ArgumentParser("Build the CoT examples index", add_help=True)
+    parser.add_argument("--documents_dir", type=str, default="./data/cot_examples")
+    parser.add_argument("--collection_name", type=str, default="cot_examples")
+    parser.add_argument("--embed_model", type=str, default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--backend", type=str, default="torch", choices=EMBEDDING_BACKENDS)
+    parser.add_argument("--rebuild", action="store_true", help="re-embed every document instead of only new or changed ones")
+    args = parser.parse_args()
+
+    build_vector_store(
+        documents_dir=args.documents_dir,
+        collection_name=args.collection_name,
+        embed_model_name=args.embed_model,
+        rebuild=args.rebuild,
+        backend=args.backend
+    )
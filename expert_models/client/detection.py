@@ -22,6 +22,11 @@ import torch
 warnings.filterwarnings("ignore")
 
 import gradio as gr
+import uvicorn
+from fastapi import FastAPI, Request, Query, HTTPException
+from fastapi.concurrency import run_in_threadpool
+
+from phrase_grouping import group_by_phrase
 
 from groundingdino.models import build_model
 from groundingdino.util.slconfig import SLConfig
@@ -66,20 +71,42 @@ def image_transform_grounding_for_vis(init_image):
 
 
 model = None
+model_version = None
 
-def detection(input_image, grounding_caption, box_threshold, text_threshold):
+
+def checkpoint_version(config_path, weights_path):
+    """Identify the loaded detector by its config and checkpoint files, so clients can key their caches on it."""
+    stat = os.stat(weights_path)
+    return f"{Path(config_path).name}:{Path(weights_path).name}:{stat.st_size}:{int(stat.st_mtime)}"
+
+
+def run_grounding(input_image, grounding_caption, box_threshold, text_threshold):
     if isinstance(input_image, str):
         input_image = Image.open(input_image)
 
     init_image = input_image.convert("RGB")
-    original_size = init_image.size
 
     _, image_tensor = image_transform_grounding(init_image)
-    image_pil: Image = image_transform_grounding_for_vis(init_image)
 
     # run grounidng
     boxes, logits, phrases = predict(model, image_tensor, grounding_caption, box_threshold, text_threshold, device='cpu')
-    
+    return init_image, boxes, logits, phrases
+
+
+def detection_json(input_image, grounding_caption, box_threshold, text_threshold):
+    """Detection result only, without rendering the annotated image."""
+    _, boxes, logits, phrases = run_grounding(input_image, grounding_caption, box_threshold, text_threshold)
+    return {
+        "bboxes": boxes.cpu().numpy().tolist(),
+        "logits": logits.cpu().numpy().tolist(),
+        "phrases": phrases
+    }
+
+
+def detection(input_image, grounding_caption, box_threshold, text_threshold):
+    init_image, boxes, logits, phrases = run_grounding(input_image, grounding_caption, box_threshold, text_threshold)
+
+    image_pil: Image = image_transform_grounding_for_vis(init_image)
     annotated_frame = annotate(image_source=np.asarray(image_pil), boxes=boxes, logits=logits, phrases=phrases)
     image_with_box = Image.fromarray(cv2.cvtColor(annotated_frame, cv2.COLOR_BGR2RGB))
     
@@ -92,6 +119,49 @@ def detection(input_image, grounding_caption, box_threshold, text_threshold):
         "phrases": phrases
     }
 
+
+app = FastAPI()
+
+
+async def read_raw_image(request: Request, width: int, height: int):
+    """The image of a request body holding its raw RGB bytes, as sent by `capagent.expert_clients.DetectionClient`."""
+    body = await request.body()
+    if width <= 0 or height <= 0 or len(body) != width * height * 3:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Expected {max(width, 0) * max(height, 0) * 3} bytes of RGB data for a {width}x{height} image, got {len(body)}."
+        )
+    return Image.frombytes("RGB", (width, height), body)
+
+
+@app.get("/version")
+def version():
+    """Version of the loaded detector, changes when the checkpoint is swapped or retrained."""
+    return {"model": model_version}
+
+
+@app.post("/detect")
+async def detect_raw_image(request: Request, caption: str, width: int, height: int, box_threshold: float = 0.35, text_threshold: float = 0.25):
+    """
+    Detection on an image sent as the raw RGB bytes of the request body, without any image
+    file encoding or temporary file. Returns the JSON of `detection`, the annotated image is
+    not rendered; it is only available from the gradio interface.
+    """
+    input_image = await read_raw_image(request, width, height)
+    return await run_in_threadpool(detection_json, input_image, caption, box_threshold, text_threshold)
+
+
+@app.post("/detect_phrases")
+async def detect_phrases_raw_image(request: Request, width: int, height: int, phrases: list[str] = Query(...), box_threshold: float = 0.35, text_threshold: float = 0.25):
+    """
+    Detection of several phrases in one forward pass, on an image sent like for /detect.
+    Returns {phrase: detection JSON} for every requested phrase.
+    """
+    input_image = await read_raw_image(request, width, height)
+    result = await run_in_threadpool(detection_json, input_image, " . ".join(phrases), box_threshold, text_threshold)
+    return group_by_phrase(phrases, result)
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser("Grounding DINO demo", add_help=True)
@@ -104,6 +174,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     model = load_model_hf(args.config, args.ckpt)
+    model_version = checkpoint_version(args.config, args.ckpt)
 
     demo = gr.Interface(fn=detection, 
                         inputs=[
@@ -115,5 +186,10 @@ if __name__ == "__main__":
                         outputs=[gr.Image(type="pil"), "json"]
                     )
     
-    demo.launch(share=True, server_name=args.host, server_port=args.port, show_error=True)
+    if args.share:
+        # a share link only exposes the gradio interface, not the /detect endpoint
+        demo.launch(share=True, server_name=args.host, server_port=args.port, show_error=True)
+    else:
+        app = gr.mount_gradio_app(app, demo, path="/", show_error=True)
+        uvicorn.run(app, host=args.host, port=args.port)
 
@@ -0,0 +1,20 @@
+def group_by_phrase(phrases, result):
+    """
+    Split the result of a multi-phrase detection ("sofa . chair . lamp") by requested phrase. Each box
+    goes to the requested phrase sharing the most words with its predicted phrase, boxes sharing no
+    word with any of them are dropped.
+    """
+    groups = {phrase: {"bboxes": [], "logits": [], "phrases": []} for phrase in phrases}
+    phrase_words = {phrase: set(phrase.lower().split()) for phrase in phrases}
+
+    for bbox, logit, predicted in zip(result["bboxes"], result["logits"], result["phrases"]):
+        predicted_words = set(predicted.lower().split())
+        # jaccard similarity of the words, an exact match scores 1
+        best = max(phrases, key=lambda phrase: len(phrase_words[phrase] & predicted_words) / max(len(phrase_words[phrase] | predicted_words), 1))
+        if not phrase_words[best] & predicted_words:
+            continue
+        groups[best]["bboxes"].append(bbox)
+        groups[best]["logits"].append(logit)
+        groups[best]["phrases"].append(predicted)
+
+    return groups
@@ -9,7 +9,8 @@ import base64
 from gradio_toggle import Toggle
 from capagent.instruction_augmenter import InstructionAugmenter
 from capagent.tools import count_words
-from run import run_agent
+from capagent.config import EXECUTOR_POOL_SIZE
+from run import run_agent_stream, get_executor_pool
 
 #IMGUR_CLIENT_ID = "YOUR_IMGUR_CLIENT_ID"
 
@@ -276,7 +277,7 @@ def generate_complex_instruction(query: str, image: PIL.Image.Image, is_search:
     except Exception as e:
         return f"Error occurred: {str(e)}", []'''
 
-def process_query(query: str,image: PIL.Image.Image) -> str:
+def process_query(query: str,image: PIL.Image.Image):
     try:
         '''# Save image persistently
         save_path = os.path.join("uploaded_images", "image.png")
@@ -292,16 +293,28 @@ def process_query(query: str,image: PIL.Image.Image) -> str:
         print("entered process query")
 
         public_url = upload_to_imgbb(image)
-        result, messages = run_agent(
+
+        # stream the planner's tokens into the response box and each step into the chain of thought
+        partial_response, messages = "", []
+        for event in run_agent_stream(
             user_query=query, 
             working_dir="uploaded_images", 
             image_paths=[public_url]  # pass public URL
-        )
-
-        return result, messages
+        ):
+            if event["type"] == "token":
+                partial_response += event["content"]
+                yield partial_response, messages
+            elif event["type"] == "message":
+                partial_response = ""
+                messages = messages + [{"role": event["role"], "content": event["content"]}]
+                yield partial_response, messages
+            elif event["type"] == "result":
+                yield event["content"], event["messages"]
+            elif event["type"] == "error":
+                yield f"Error occurred: {event['content']}", messages
         
     except Exception as e:
-        return f"Error occurred: {str(e)}", []
+        yield f"Error occurred: {str(e)}", []
 
 
 def launch_gradio_demo():
@@ -373,6 +386,10 @@ def launch_gradio_demo():
         )
     
     
+    # Warm up the executors before the first request, and let as many requests run as there are executors
+    get_executor_pool()
+    demo.queue(default_concurrency_limit=EXECUTOR_POOL_SIZE)
+
     # Launch the demo
     demo.launch(
         share=True,                    # Create a public link
@@ -1,8 +1,13 @@
-# Delete the chroma_db directory if it exists
-if (Test-Path "./chroma_db") {
-    Remove-Item -Recurse -Force "./chroma_db"
-}
+# Only new or changed CoT examples are embedded, pass -rebuild to re-embed all of them
+param([switch]$rebuild)
 
 # Run the embedding script
 $env:CUDA_VISIBLE_DEVICES = "1"
-python embedding.py
+if ($rebuild) {
+    python embedding.py --rebuild
+} else {
+    python embedding.py
+}
+
+# Rebuild the constraint routing table of the CoT examples
+python -m capagent.example_routing
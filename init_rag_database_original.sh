@@ -1,5 +1,5 @@
-if [ -d "./chroma_db" ]; then
-    rm -rf ./chroma_db
-fi
+# Only new or changed CoT examples are embedded, pass --rebuild to re-embed all of them
+CUDA_VISIBLE_DEVICES=1 python3 embedding.py "$@"
 
-CUDA_VISIBLE_DEVICES=1 python3 embedding.py
+# Rebuild the constraint routing table of the CoT examples
+python3 -m capagent.example_routing
@@ -1,5 +1,6 @@
 import re
 import os
+import threading
 from autogen.agentchat import ConversableAgent
 
 from capagent.agent import (
@@ -11,7 +12,8 @@ from capagent.prompt import (
     ReActPrompt, 
     ASSISTANT_SYSTEM_MESSAGE
 )
-from capagent.execution import CodeExecutor
+from capagent.execution import ExecutorPool
+from capagent.config import EXECUTOR_POOL_SIZE
 from capagent.parse import Parser
 from capagent.chat_models.client import mllm_client
 from capagent.utils import encode_pil_to_base64
@@ -31,23 +33,33 @@ def extract_tool_comments(file_path):
     return tool_comments
 
 
+_executor_pool = None
+_executor_pool_lock = threading.Lock()
 
-def run_agent(user_query: str, working_dir: str, image_paths: list[str] = None):
-    print("****in run agent*****")
-    prompt_generator = ReActPrompt()
-    print("prompt succesful")
-    executor = CodeExecutor(working_dir=working_dir, use_tools=True)
-    print("code exec hogaya")
-    parser = Parser()
+
+def get_executor_pool(size: int = EXECUTOR_POOL_SIZE) -> ExecutorPool:
+    """Return the process-wide executor pool, warming it up on first use."""
+    global _executor_pool
+    with _executor_pool_lock:
+        if _executor_pool is None:
+            _executor_pool = ExecutorPool(size=size, use_tools=True)
+    return _executor_pool
+
+
+def load_images(executor, image_paths: list[str] = None):
     print("IMage paths sentto run_agent",image_paths)
     if image_paths is not None:
         image_loading_result = executor.loading_images(image_paths)
         if image_loading_result[0] != 0:
             raise Exception(f"Error loading images: {image_loading_result[1]}")
-    else:
-        image_loading_result = None
 
 
+def build_agents(executor, stream: bool = False):
+    """Create the CapAgent user proxy and the planner. With `stream`, the planner streams its completions."""
+    prompt_generator = ReActPrompt()
+    print("prompt succesful")
+    parser = Parser()
+
     print("****in run agent 2*****")
     user_proxy = CapAgent(
         name="Assistant",
@@ -86,8 +98,8 @@ def run_agent(user_query: str, working_dir: str, image_paths: list[str] = None):
             "base_url": "https://openrouter.ai/api/v1",
             "price": [0, 0]
         }
-    ]
-
+    ],
+        "stream": stream
         },
         human_input_mode="NEVER",
         max_consecutive_auto_reply=10,
@@ -95,16 +107,56 @@ def run_agent(user_query: str, working_dir: str, image_paths: list[str] = None):
         system_message=ASSISTANT_SYSTEM_MESSAGE,
     )
 
-    print("ippud initiate chat aithadhi")
-    chat_result, messages = user_proxy.initiate_chat(
-        assistant, 
-        message=user_query, 
-        n_image=len(image_paths) if image_paths is not None else 0
-    )
+    return user_proxy, assistant
+
+
+def run_agent(user_query: str, working_dir: str, image_paths: list[str] = None, executor_pool: ExecutorPool = None, cot_examples: str = None):
+    print("****in run agent*****")
+    executor_pool = executor_pool or get_executor_pool()
+    executor = executor_pool.acquire(working_dir=working_dir)
+    print("code exec hogaya")
+    try:
+        load_images(executor, image_paths)
+        user_proxy, assistant = build_agents(executor)
+
+        print("ippud initiate chat aithadhi")
+        chat_result, messages = user_proxy.initiate_chat(
+            assistant, 
+            message=user_query, 
+            n_image=len(image_paths) if image_paths is not None else 0,
+            cot_examples=cot_examples
+        )
+
+    finally:
+        # hand the warm executor back for the next session
+        executor_pool.release(executor)
 
     return chat_result, messages
 
 
+def run_agent_stream(user_query: str, working_dir: str, image_paths: list[str] = None, executor_pool: ExecutorPool = None):
+    """
+    Streaming version of `run_agent`. Yields the events of `CapAgent.initiate_chat_stream`: planner
+    tokens as they are generated, each THOUGHT/ACTION and OBSERVATION message, and finally the result.
+    """
+    executor_pool = executor_pool or get_executor_pool()
+    executor = executor_pool.acquire(working_dir=working_dir)
+    try:
+        load_images(executor, image_paths)
+        user_proxy, assistant = build_agents(executor, stream=True)
+    except BaseException:
+        executor_pool.release(executor)
+        raise
+
+    # the chat thread releases the executor when the chat ends, also if the consumer stops listening early
+    yield from user_proxy.initiate_chat_stream(
+        assistant,
+        message=user_query,
+        n_image=len(image_paths) if image_paths is not None else 0,
+        on_done=lambda: executor_pool.release(executor)
+    )
+
+
 if __name__ == "__main__":
     
     user_query = """Create a detailed description of the image, focusing on the central figure seated in an ornate throne, wearing an elaborate crown and regal robes. Highlight the presence of clergy in ceremonial attire standing nearby, emphasizing their roles in the event. Note the richly decorated surroundings, including the vibrant colors and intricate patterns. Mention the distinguished guests in formal attire seated in the background, adding context to the ceremonial setting. The description should be informative and concise, around 100 words, with a formal and respectful tone.
@@ -0,0 +1,76 @@
+import pytest
+
+chromadb = pytest.importorskip("chromadb")
+pytest.importorskip("llama_index.vector_stores.chroma")
+
+from capagent import indexing
+
+
+@pytest.fixture
+def chroma_dir(tmp_path, monkeypatch):
+    # indexing opens ./chroma_db, keep it and the process-wide handles local to the test
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(indexing, "_chroma_client", None)
+    monkeypatch.setattr(indexing, "_vector_stores", {})
+    monkeypatch.setattr(indexing, "_example_indexes", {})
+    monkeypatch.setattr(indexing, "_hybrid_indexes", {})
+
+    collection = chromadb.PersistentClient(path="./chroma_db").get_or_create_collection("cot_examples")
+    collection.add(
+        ids=["0", "1", "2"],
+        documents=["# EXAMPLE: length", "# EXAMPLE: sentiment", "# EXAMPLE: spatial"],
+        embeddings=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]],
+    )
+    return tmp_path
+
+
+def test_load_vector_store_is_cached(chroma_dir):
+    vector_store = indexing.load_vector_store("cot_examples")
+    assert indexing.load_vector_store("cot_examples") is vector_store
+
+
+def test_load_example_index(chroma_dir):
+    example_index = indexing.load_example_index("cot_examples")
+    assert example_index.query([0.1, 0.9, 0.0], top_k=2) == ["# EXAMPLE: sentiment", "# EXAMPLE: length"]
+    assert example_index.query_batch([[0.0, 0.0, 1.0], [1.0, 0.0, 0.0]], top_k=1) == [["# EXAMPLE: spatial"], ["# EXAMPLE: length"]]
+
+
+def test_load_hybrid_index(chroma_dir):
+    hybrid_index = indexing.load_hybrid_index("cot_examples")
+    assert hybrid_index.texts == indexing.load_example_index("cot_examples").texts
+
+
+def test_empty_example_index():
+    example_index = indexing.InMemoryExampleIndex([], [])
+    assert example_index.query([1.0, 0.0, 0.0], top_k=2) == []
+    assert indexing.HybridExampleIndex(example_index).query("caption in 10 words", top_k=2) == []
+
+
+class _FakeEmbedding:
+    """Embeds a text as [1, its length]. The batched path may see another query instruction than the single one."""
+
+    def __init__(self, query_instruction, batched_instruction=None):
+        self.query_instruction = query_instruction
+        self.batched_instruction = query_instruction if batched_instruction is None else batched_instruction
+        self.single_calls = 0
+
+    def get_query_embedding(self, query):
+        self.single_calls += 1
+        return [1.0, float(len(self.query_instruction + query))]
+
+    def get_text_embedding_batch(self, texts):
+        return [[1.0, float(len(text) - len(self.query_instruction) + len(self.batched_instruction))] for text in texts]
+
+
+def test_embed_query_batch_applies_the_query_instruction():
+    embed_model = _FakeEmbedding("query: ")
+    assert indexing.embed_query_batch(embed_model, ["a", "bb"]) == [[1.0, 8.0], [1.0, 9.0]]
+    # only the first batch is checked against get_query_embedding
+    indexing.embed_query_batch(embed_model, ["a", "bb"])
+    assert embed_model.single_calls == 1
+
+
+def test_embed_query_batch_falls_back_when_the_batch_differs():
+    embed_model = _FakeEmbedding("query: ", batched_instruction="a much longer query prompt: ")
+    assert indexing.embed_query_batch(embed_model, ["a", "bb"]) == [[1.0, 8.0], [1.0, 9.0]]
+    assert indexing.embed_query_batch(embed_model, ["ccc"]) == [[1.0, 10.0]]
@@ -0,0 +1,40 @@
+import os
+import sys
+
+# the detection server imports its helpers as siblings, it is started from expert_models/client
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "expert_models", "client"))
+
+from phrase_grouping import group_by_phrase
+
+
+def detections(*phrases):
+    return {
+        "bboxes": [[0.1 * i, 0.1 * i, 0.1, 0.1] for i in range(len(phrases))],
+        "logits": [0.5 + 0.01 * i for i in range(len(phrases))],
+        "phrases": list(phrases),
+    }
+
+
+def test_boxes_go_to_their_phrase():
+    groups = group_by_phrase(["sofa", "lamp"], detections("sofa", "lamp", "sofa"))
+
+    assert groups["sofa"]["phrases"] == ["sofa", "sofa"]
+    assert groups["sofa"]["bboxes"] == [[0.0, 0.0, 0.1, 0.1], [0.2, 0.2, 0.1, 0.1]]
+    assert groups["sofa"]["logits"] == [0.5, 0.52]
+    assert groups["lamp"]["phrases"] == ["lamp"]
+
+
+def test_overlapping_phrases_go_to_the_closest_one():
+    groups = group_by_phrase(["chair", "office chair"], detections("office chair", "chair", "office"))
+
+    assert groups["office chair"]["phrases"] == ["office chair", "office"]
+    assert groups["chair"]["phrases"] == ["chair"]
+
+
+def test_unmatched_boxes_are_dropped_and_every_phrase_is_returned():
+    groups = group_by_phrase(["cat", "table"], detections("sofa"))
+
+    assert groups == {
+        "cat": {"bboxes": [], "logits": [], "phrases": []},
+        "table": {"bboxes": [], "logits": [], "phrases": []},
+    }